@@ -6,23 +6,16 @@
 
 import streamlit as st
 import pandas as pd
-from tqdm.auto import tqdm
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 from io import BytesIO
+import hashlib
 from datetime import datetime
 import os
 from statsmodels.tsa.arima.model import ARIMA
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-from pmdarima import auto_arima
-from statsmodels.tsa.holtwinters import ExponentialSmoothing
-from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
-import datetime as dt
-from kneed import KneeLocator
 import warnings
-from mpl_toolkits.mplot3d import Axes3D
 warnings.filterwarnings('ignore')
 import plotly.express as px
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
@@ -30,6 +23,20 @@ from wordcloud import WordCloud
 import nltk
 import squarify
 from matplotlib.ticker import FuncFormatter
+from sales_data import (month_columns, compact_sales_frame, memory_footprint, build_rollups,
+                        build_sales_facts, month_facts, build_row_index, row_positions,
+                        stream_rollups, list_datasets, dataset_version, publish_dataset, read_dataset,
+                        read_rollups, read_running_stats, append_month)
+from sales_alerts import (find_returns, find_sales_dips, find_consecutive_drops, activity_coverage, alert_store_path,
+                          read_alert_meta, read_alerts, dips_from_running_stats)
+from sales_forecasting import (series_fingerprint, cached_model, product_series, forecast_catalogue, SMOOTHING_METHODS,
+                               smoothing_forecast, smoothing_catalogue, forecast_errors, BACKTEST_ENGINES,
+                               rolling_origin_backtest, backtest_summary, RECONCILIATION_METHODS, hierarchical_forecast,
+                               inventory_plan, ARIMA_ENGINES)
+from segmentation import (K_RANGE, MINIBATCH_THRESHOLD, DRIFT_THRESHOLD, k_sweep, choose_clusters,
+                          read_customer_totals, rfm_table, rfm_scores, segment_labels, segmentation_state,
+                          batch_applied, update_segmentation, segmented_rfm, segmentation_drift, segmentation_path,
+                          save_segmentation, load_segmentation, SCATTER_BUDGET, scatter_sample)
 
 # Download NLTK vader_lexicon if not already downloaded
 try:
@@ -109,15 +116,14 @@ def save_plot(fig, filename):
     fig.savefig(filename)
     return filename
 
-# Function to plot data
-def plot_data(selected_towns, data):
+# Function to plot data from the town rollup
+def plot_data(selected_towns, town_rollup):
     if selected_towns:
-        filtered_data = data[data['TOWN'].isin(selected_towns)]
+        town_dispensing = town_rollup[town_rollup.index.isin(selected_towns)]
     else:
         # If no towns are selected, display data for all towns
-        filtered_data = data
+        town_dispensing = town_rollup
 
-    town_dispensing = filtered_data.groupby('TOWN').sum(numeric_only=True)
     total_dispensed_per_town = town_dispensing.sum(axis=1).sort_values(ascending=False)
 
     plt.figure(figsize=(12, 6))
@@ -131,15 +137,15 @@ def plot_data(selected_towns, data):
     plt.show()
     st.pyplot(plt)
 
-# Function to plot data
-def plot_product_distribution_by_towns(selected_products, selected_towns, data):
+# Function to plot data from the town x product rollup
+def plot_product_distribution_by_towns(selected_products, selected_towns, town_product_rollup):
     for selected_product in selected_products:
         # Filtering data based on the selected product and towns
-        filtered_data = data[data['DISCRIPTION'] == selected_product]
+        filtered_data = town_product_rollup.xs(selected_product, level='DISCRIPTION')
         if selected_towns:
-            filtered_data = filtered_data[filtered_data['TOWN'].isin(selected_towns)]
+            filtered_data = filtered_data[filtered_data.index.isin(selected_towns)]
 
-        town_distribution = filtered_data.groupby('TOWN').sum().sum(axis=1).sort_values(ascending=False)
+        town_distribution = filtered_data.sum(axis=1).sort_values(ascending=False)
 
         plt.figure(figsize=(12, 6))
         town_distribution.plot(kind='bar', color='teal')
@@ -152,30 +158,132 @@ def plot_product_distribution_by_towns(selected_products, selected_towns, data):
         plt.show()
         st.pyplot(plt)
         
-# Define a function to load data
-def load_data(uploaded_file):
+# Parse CSV bytes once per distinct content; the digest is the cache key so the
+# raw bytes themselves never have to be hashed by Streamlit on a rerun
+@st.cache_data(max_entries=8, show_spinner=False)
+def _parse_csv(digest, _raw, **read_csv_kwargs):
+    return pd.read_csv(BytesIO(_raw), **read_csv_kwargs)
+
+# Identifier columns each sales page needs from a published dataset; None loads all
+# of them and pages not listed here do not use the sales sheet at all
+PAGE_ID_COLUMNS = {
+    'Trend Analysis': ['DISCRIPTION'],
+    'Geographical Analysis': ['TOWN', 'DISCRIPTION'],
+    'Product Performance': None,
+    'Pharmacy Performance': ['NAME', 'DISCRIPTION'],
+    'Alerts': None,
+    'Sales Forecasting': None,
+}
+
+# Sales pages that can run from the monthly rollups alone, e.g. in streaming mode
+ROLLUP_PAGES = ['Trend Analysis', 'Geographical Analysis', 'Product Performance']
+
+# Open a published dataset; the version token invalidates the cache on republish
+@st.cache_data(max_entries=8, show_spinner=False)
+def open_dataset(name, version, id_columns=None, include_months=True):
+    return read_dataset(name, id_columns, include_months)
+
+# Stored rollup cube of a published dataset, kept up to date by monthly appends
+@st.cache_resource(max_entries=4, show_spinner=False)
+def open_rollups(name, version):
+    return read_rollups(name)
+
+# Function to read an uploaded CSV through the content-hashed cache
+def read_uploaded_csv(uploaded_file, **read_csv_kwargs):
+    """Returns the parsed DataFrame for an upload, reusing it while the file content is unchanged."""
+    raw = uploaded_file.getvalue()
+    digest = hashlib.sha256(raw).hexdigest()
+    return _parse_csv(digest, raw, **read_csv_kwargs)
+
+# Parse the sales sheet once per upload into its compact typed form, keeping the
+# memory footprint before and after typing for the sidebar report
+@st.cache_data(max_entries=4, show_spinner=False)
+def _parse_sales_csv(digest, _raw):
+    data = pd.read_csv(BytesIO(_raw))
+    before = memory_footprint(data)
+    data = compact_sales_frame(data)
+    return data, before, memory_footprint(data)
+
+# Function to load the uploaded sales sheet
+def read_sales_upload(uploaded_file):
+    """Returns the content digest and typed sales sheet for an upload, with its memory footprint before and after typing."""
+    raw = uploaded_file.getvalue()
+    digest = hashlib.sha256(raw).hexdigest()
+    return (digest,) + _parse_sales_csv(digest, raw)
+
+# Rollup cube of the loaded sales sheet, built once per data key and shared across
+# reruns and sessions without copying; pages only read from it
+@st.cache_resource(max_entries=4, show_spinner=False)
+def sales_rollups(data_key, _data):
+    return build_rollups(_data)
+
+# Long-format sales fact table, built once per data key and shared like the cube
+@st.cache_resource(max_entries=4, show_spinner=False)
+def sales_facts(data_key, _data):
+    return build_sales_facts(_data)
+
+# Inverted town/pharmacy/product row indexes, built once per data key and reused across reruns
+@st.cache_resource(max_entries=4, show_spinner=False)
+def sales_row_index(data_key, _data):
+    return build_row_index(_data)
+
+# Months with sales, longest active streak and first/last active month per pharmacy,
+# computed once per data key and product selection from the rollup cube
+@st.cache_resource(max_entries=32, show_spinner=False)
+def pharmacy_activity(data_key, product, _pharmacy_monthly):
+    return activity_coverage(_pharmacy_monthly)
+
+# Stream a sales CSV from disk into its monthly rollups; the modification time
+# invalidates the cache when the file is replaced
+@st.cache_resource(max_entries=4, show_spinner='Streaming the sales file...')
+def stream_sales_file(path, mtime, chunksize):
+    return stream_rollups(path, chunksize)
+
+# Alert store written by the batch job (python sales_alerts.py <dataset>), used only while
+# it was computed from the current version of the dataset
+def fresh_alert_store(name, version):
+    path = alert_store_path(name)
+    meta = read_alert_meta(path)
+    return (path, meta) if meta is not None and meta['version'] == str(version) else None
+
+# Fitted forecast model of a product's series, kept in memory on top of the on-disk model cache
+@st.cache_resource(max_entries=64, show_spinner='Fitting the forecast model...')
+def forecast_model(product, fingerprint, kind, _series):
+    return cached_model(product, _series, kind)
+
+# Elbow sweep of the scaled RFM values, fitted once per upload and clustering algorithm
+@st.cache_resource(max_entries=4, show_spinner='Clustering customers...')
+def segment_sweep(rfm_key, minibatch, _rfm_scaled):
+    return k_sweep(_rfm_scaled, K_RANGE, minibatch)
+
+# Saved segmentation state; the modification time invalidates the cache when it is saved again
+@st.cache_resource(max_entries=2, show_spinner=False)
+def saved_segmentation(mtime):
+    return load_segmentation()
+
+# Reduce an uploaded invoice file to customer totals chunk by chunk, once per distinct content
+@st.cache_data(max_entries=4, show_spinner='Reading the invoices...')
+def _parse_invoice_totals(digest, _raw):
+    return read_customer_totals(BytesIO(_raw))
+
+# Simulated demand percentiles and stock recommendations of every product, recomputed only
+# when the data or the simulation settings change rather than on every rerun of the page
+@st.cache_data(max_entries=8, show_spinner='Simulating demand paths...')
+def product_stock_plan(data_key, horizon, lead_time, service_level, n_paths, _product_rollup):
+    return inventory_plan(_product_rollup, horizon, lead_time, service_level, n_paths=n_paths)
+
+# Define a function to load the customer totals of an uploaded invoice file
+def load_invoice_totals(uploaded_file):
     if uploaded_file is not None:
-        data = pd.read_csv(uploaded_file)
-        # Attempt to convert 'Invoice Date' to datetime format
+        raw = uploaded_file.getvalue()
         try:
-            data['Invoice Date'] = pd.to_datetime(data['Invoice Date'], format='%d/%m/%Y')
+            return _parse_invoice_totals(hashlib.sha256(raw).hexdigest(), raw)
         except Exception as e:
-            st.error(f"Error in converting 'Invoice Date' to datetime: {e}")
+            st.error(f"Error in reading the invoices: {e}")
             return None
-        return data
     else:
         return None
-    
-def cluster_segments (rfm):
-    if(rfm.RFM_SCORE>=450):
-        return 'High Value Customers'
-    if(rfm.RFM_SCORE>=340 and rfm.RFM_SCORE<450):
-        return 'Potential Loyalist'
-    if(rfm.RFM_SCORE>=280 and rfm.RFM_SCORE<340):
-        return 'At Risk'
-    else:
-        return 'Sleelpig Customers'
-    
+
 # Function to calculate NPS
 def calculate_nps(scores):
     promoters = len([score for score in scores if score >= 9])
@@ -212,12 +320,92 @@ if username_guess and password_guess:
 if username_guess == st.secrets["username"] and password_guess == st.secrets["password"]:
     st.success("Username and password are correct")
 
-    # File uploader
-    uploaded_file = st.sidebar.file_uploader("Choose a CSV file", type="csv")
-    if uploaded_file is not None:
-        data = pd.read_csv(uploaded_file)
+    # Sales data either comes from a CSV upload, a published dataset or a file streamed from disk
+    data_source = st.sidebar.radio('Sales data source:', ['Upload CSV', 'Published dataset', 'Stream large CSV'])
+    data = None
+    rollups = None
+    alert_store = None
+
+    if data_source == 'Upload CSV':
+        # File uploader
+        uploaded_file = st.sidebar.file_uploader("Choose a CSV file", type="csv")
+        if uploaded_file is not None:
+            digest, data, raw_bytes, typed_bytes = read_sales_upload(uploaded_file)
+            data_key = ('upload', digest)
+            st.sidebar.caption(f"Sales data in memory: {typed_bytes / 2**20:.1f} MB "
+                               f"(was {raw_bytes / 2**20:.1f} MB before typing)")
+
+            # Publish the upload as a local columnar dataset so later sessions can open it by name
+            with st.sidebar.expander('Publish dataset'):
+                dataset_name = st.text_input('Dataset name', value=os.path.splitext(uploaded_file.name)[0])
+                if st.button('Publish'):
+                    try:
+                        manifest = publish_dataset(data, dataset_name)
+                        st.success(f"Published '{dataset_name}' with {manifest['rows']} rows and {len(manifest['months'])} months")
+                    except ValueError as e:
+                        st.error(str(e))
+    elif data_source == 'Published dataset':
+        datasets = list_datasets()
+        if datasets:
+            dataset_name = st.sidebar.selectbox('Select a dataset', datasets)
+
+            # Merge next month's column into the dataset instead of re-uploading the whole sheet
+            with st.sidebar.expander('Append month'):
+                month_file = st.file_uploader('CSV with C-CODE, P-CODE and the new month column', type='csv', key='append_file')
+                if month_file is not None and st.button('Append to dataset'):
+                    try:
+                        appended = append_month(dataset_name, read_uploaded_csv(month_file))['last_append']
+                        st.success(f"Added {appended['month']}: {appended['matched_rows']} rows matched, "
+                                   f"{appended['added_rows']} new rows, {appended['skipped_keys']} keys skipped")
+
+                        # New-month dips straight from the running statistics, without rescanning earlier months
+                        new_dips = dips_from_running_stats(read_running_stats(dataset_name), appended['month'])
+                        st.info(f"{len(new_dips)} pharmacy products sold below their average in {appended['month']}")
+                        # The alert store averages over every month, so a new month invalidates all of it
+                        if os.path.isfile(alert_store_path(dataset_name)):
+                            st.warning(f"The precomputed alerts are now out of date; the Alerts page computes them live "
+                                       f"until `python sales_alerts.py {dataset_name}` is run again.")
+                    except ValueError as e:
+                        st.error(str(e))
+
+            if options in PAGE_ID_COLUMNS:
+                id_columns = PAGE_ID_COLUMNS[options]
+                id_columns = tuple(id_columns) if id_columns is not None else None
+                version = dataset_version(dataset_name)
+                data = open_dataset(dataset_name, version, id_columns)
+                data_key = ('dataset', dataset_name, version, id_columns)
+                rollups = open_rollups(dataset_name, version)
+                alert_store = fresh_alert_store(dataset_name, version)
+                if alert_store is not None:
+                    st.sidebar.caption(f"Alerts precomputed on {alert_store[1]['computed']}")
+                st.sidebar.caption(f"Sales data in memory: {memory_footprint(data) / 2**20:.1f} MB")
+            else:
+                data = open_dataset(dataset_name, dataset_version(dataset_name), (), include_months=False)
+        else:
+            st.sidebar.info('No published datasets yet. Upload a CSV file and publish it first.')
+    else:
+        # Streaming mode only keeps the monthly rollups, never the raw rows
+        sales_path = st.sidebar.text_input('Path to the sales CSV on the server').strip()
+        chunksize = st.sidebar.number_input('Rows per chunk', min_value=10000, value=200000, step=10000)
+        if sales_path:
+            if os.path.isfile(sales_path):
+                rollups = stream_sales_file(sales_path, os.stat(sales_path).st_mtime_ns, chunksize)
+            else:
+                st.sidebar.error(f"File not found: {sales_path}")
+
+    if data is not None or rollups is not None:
+        if rollups is None and options in PAGE_ID_COLUMNS:
+            rollups = sales_rollups(data_key, data)
+        if data is not None and options in PAGE_ID_COLUMNS:
+            row_index = sales_row_index(data_key, data)
+
+        # Month columns of the wide sales sheet, in file order
+        month_cols = month_columns(data.columns) if data is not None else rollups['total'].index.tolist()
 
-        if options == 'Trend Analysis':
+        if data is None and options in PAGE_ID_COLUMNS and options not in ROLLUP_PAGES:
+            st.warning(f"{options} needs the full sales sheet. Streaming mode supports {', '.join(ROLLUP_PAGES)}.")
+
+        elif options == 'Trend Analysis':
             st.header('Trend Analysis')
             st.subheader('Trend Anaysis Total Units')
             # Include your product performance analysis code here
@@ -225,7 +413,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             # Summing up the quantity for each month across all products and pharmacies
 
             # User input for product selection using multiselect
-            products = sorted(data['DISCRIPTION'].unique().tolist())
+            products = sorted(rollups['product'].index.tolist())
             selected_products = st.multiselect('Select Products (leave blank for all products)', products)
 
             # Sorting the selected products in ascending order
@@ -234,11 +422,8 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             # Filtering data and plotting trends based on product selection
             if selected_products:
                 for product in selected_products:
-                    # Filtering data for the selected product
-                    filtered_data = data[data['DISCRIPTION'] == product]
-
-                    # Preparing data for trend analysis
-                    monthly_totals = filtered_data.iloc[:, 5:].sum()
+                    # Monthly totals for the selected product from the product rollup
+                    monthly_totals = rollups['product'].loc[product]
 
                     # Plotting the trend for each selected product
                     fig, ax = plt.subplots(figsize=(12, 6))
@@ -264,7 +449,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                     )
             else:
                 # Preparing data for trend analysis for all products
-                monthly_totals = data.iloc[:, 5:].sum()
+                monthly_totals = rollups['total']
 
                 # Plotting the trend for all products
                 fig, ax = plt.subplots(figsize=(12, 6))
@@ -292,8 +477,8 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
 
             # Analyzing the trend for each product brand (DISCRIPTION)
 
-            # Grouping the data by 'DISCRIPTION' and summing up the quantities for each month
-            product_trends = data.groupby('DISCRIPTION').sum(numeric_only=True)
+            # Quantities for each month per 'DISCRIPTION', from the product rollup
+            product_trends = rollups['product']
 
             # Transposing the dataframe for easier plotting
             product_trends_transposed = product_trends.T
@@ -417,26 +602,24 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             st.header('Geographical Analysis')
             st.subheader('Overall Unit Sales by Town')
 
-            # Convert all town names to strings and filter out any NaN or missing values
-            towns = data['TOWN'].dropna().astype(str).unique()
+            # Convert all town names to strings; the rollup already leaves out missing towns
+            towns = rollups['town'].index.astype(str).unique()
             towns = sorted(towns)
             selected_towns = st.multiselect('Select Towns', towns)
 
             # Display plot
-            plot_data(selected_towns, data)
+            plot_data(selected_towns, rollups['town'])
 
             # Town and Product selection
             st.subheader('Unit Sales by Town and Product')
-            towns = data['TOWN'].dropna().astype(str).unique()
-            towns = sorted(towns)
-            products = data['DISCRIPTION'].dropna().astype(str).unique()
+            products = rollups['product'].index.astype(str).unique()
             products = sorted(products)
             selected_towns = st.multiselect('Select Towns', towns, key='select_towns')
             selected_products = st.multiselect('Select Products', products, key='select_products')
 
             # Display plot
             if selected_products:
-                plot_product_distribution_by_towns(selected_products, selected_towns, data)
+                plot_product_distribution_by_towns(selected_products, selected_towns, rollups['town_product'])
             else:
                 st.write("Please select one or more products to view their distribution.")
 
@@ -450,18 +633,19 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             num_towns = st.number_input('Select number of top towns to analyze', min_value=1, value=10, step=1)
             num_products = st.number_input('Select number of top products to analyze', min_value=1, value=10, step=1)
 
-            # Grouping and summarizing data
-            town_dispensing = data.groupby('TOWN').sum(numeric_only=True)
-            product_trends = data.groupby('DISCRIPTION').sum(numeric_only=True)
+            # Town and product summaries from the monthly rollups
+            town_dispensing = rollups['town']
+            product_trends = rollups['product']
+            town_product = rollups['town_product']
             total_dispensed_per_town = town_dispensing.sum(axis=1, numeric_only=True).sort_values(ascending=False)
 
             # Selecting top N towns and products
             top_towns = total_dispensed_per_town.nlargest(num_towns).index
             top_products = product_trends.sum(axis=1, numeric_only=True).nlargest(num_products).index
 
-            # Filtering and aggregating data
-            filtered_data = data[data['TOWN'].isin(top_towns) & data['DISCRIPTION'].isin(top_products)]
-            town_brand_aggregated = filtered_data.groupby(['TOWN', 'DISCRIPTION']).sum(numeric_only=True).reset_index()
+            # Filtering the town x product rollup to the top towns and products
+            town_brand_aggregated = town_product[town_product.index.get_level_values('TOWN').isin(top_towns) &
+                                                 town_product.index.get_level_values('DISCRIPTION').isin(top_products)].reset_index()
 
             # Creating summary tables for each town and saving them as CSV
             for town in top_towns:
@@ -485,7 +669,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 )
 
             # Calculating the total quantity dispensed for each product
-            total_quantity_by_product = data.groupby('DISCRIPTION').sum(numeric_only=True).sum(axis=1).sort_values(ascending=False)
+            total_quantity_by_product = product_trends.sum(axis=1).sort_values(ascending=False)
             st.subheader("Total Quantity Sold for Each Product:")
             st.table(total_quantity_by_product.head(10))  # Displaying top 10
 
@@ -493,7 +677,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             top_10_products = total_quantity_by_product.nlargest(10)
 
             # Analyzing monthly trends for these top 10 products
-            monthly_trends_top_10 = data[data['DISCRIPTION'].isin(top_10_products.index)].groupby('DISCRIPTION').sum(numeric_only=True)
+            monthly_trends_top_10 = product_trends[product_trends.index.isin(top_10_products.index)]
             st.subheader("Monthly Trends for Top 10 Products:")
             st.table(monthly_trends_top_10)
 
@@ -507,7 +691,8 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             )
 
             # Analyzing distribution across towns for these top 10 products
-            distribution_across_towns_top_10 = data[data['DISCRIPTION'].isin(top_10_products.index)].groupby(['DISCRIPTION', 'TOWN']).sum(numeric_only=True).sum(axis=1).unstack(fill_value=0)
+            top_10_town_product = town_product[town_product.index.get_level_values('DISCRIPTION').isin(top_10_products.index)]
+            distribution_across_towns_top_10 = top_10_town_product.sum(axis=1).unstack('TOWN', fill_value=0)
             st.subheader("Distribution Across Towns for Top 10 Products:")
             st.table(distribution_across_towns_top_10)
 
@@ -520,28 +705,32 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 mime='text/csv'
             )
 
+            # The pharmacy-level sections below work on raw rows, which streaming mode does not keep
+            if data is None:
+                st.info("Top N Product Performance by Pharmacy and Top Product Returns need the full sales sheet "
+                        "and are not available in streaming mode.")
+                st.stop()
+
             # Product Performance by Pharmacy filtered by month-year
 
-            # Melting the dataset to convert it from wide format to long format
-            # This helps in plotting time series data more easily
-            # Unique months in the dataset for the dropdown
-            # Melting the DataFrame
-            df_melted = data.melt(id_vars=['C-CODE', 'NAME', 'TOWN', 'P-CODE', 'DISCRIPTION'], 
-                                var_name='Month', value_name='Sales')
+            # Long-format fact table (one row per non-zero pharmacy x product x month),
+            # built once per dataset and indexed by month
+            facts = sales_facts(data_key, data)
 
             st.subheader('Top N Product Performance by Pharmacy')
 
-            months = df_melted['Month'].unique()
+            # Unique months in the dataset for the dropdown
+            months = month_cols
             selected_month = st.selectbox('Select a Month', months)
 
             # User input for number of top products
             num_products = st.number_input('Select number of top products', min_value=1, value=5, step=1)
 
-            # Filtering the data based on the selected month
-            filtered_data = df_melted[df_melted['Month'] == selected_month]
+            # Slicing the fact table to the selected month
+            filtered_data = month_facts(facts, selected_month)
 
             # Aggregating sales data by 'NAME' and 'DISCRIPTION'
-            aggregated_data = filtered_data.groupby(['NAME', 'DISCRIPTION'])['Sales'].sum().reset_index()
+            aggregated_data = filtered_data.groupby(['NAME', 'DISCRIPTION'], observed=True)['Units'].sum().reset_index(name='Sales')
 
             # Sorting by sales and getting the top N products
             top_n_products = aggregated_data.sort_values(by='Sales', ascending=False).head(num_products)
@@ -571,95 +760,67 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
 
             # Filtering data by selected town if not 'All Towns'
             if selected_town != 'All Towns':
-                data = data[data['TOWN'] == selected_town]
+                data = data.iloc[row_positions(row_index, TOWN=selected_town)]
 
             num_alerts = st.number_input('Select number of top return alerts to display', min_value=1, value=20, step=1)
 
-            # Common function to generate alerts
-            def generate_alerts(data):
-                alerts = []
-                grouped_data = data.groupby(['NAME', 'DISCRIPTION'])
-
-                for (pharmacy, product), group in grouped_data:
-                    monthly_sales = group.iloc[:, 5:]  # includes monthly last column
-                    last_month_returns = monthly_sales.iloc[:, -1]  # Focusing on the last month
-
-                    if last_month_returns.values[0] < 0:
-                        returns = abs(last_month_returns.values[0])
-                        alert_message = f"Alert: {product} at {pharmacy} - Returns last month: {returns} units"
-                        alerts.append((alert_message, pharmacy, product, returns))
-
-                return alerts
-
-            alerts = generate_alerts(data)
-
-            # Handling no alerts case
-            if not alerts:
-                st.subheader(f"Top {num_alerts} Product Returns Last Month Alerts")
-                st.write("No return for the selected period and/or town")
+            # Every return in the selected rows, across all months, in one vectorized pass
+            if alert_store is not None:
+                returns = read_alerts(alert_store[0], 'returns', **({'TOWN': selected_town} if selected_town != 'All Towns' else {}))
             else:
-                # Displaying top N alerts for narration
-                st.subheader(f"Top {num_alerts} Product Returns Last Month Alerts")
-                for alert in sorted(alerts, key=lambda x: x[3], reverse=True)[:num_alerts]:
-                    st.write(alert[0])  # Displaying the alert message
-
-                # Creating and displaying DataFrame
-                alerts_df = pd.DataFrame(alerts, columns=["Alert", "Pharmacy", "Product", "Returns"])
-                top_alerts_df = alerts_df.sort_values(by='Returns', ascending=False).head(num_alerts)
-                st.subheader(f"Top {num_alerts} Product Returns Last Month Alerts Table")
-                st.table(top_alerts_df.drop(columns="Alert"))
+                returns = find_returns(data, month_cols)
+
+            # The last month and the month before last are presets over the same records
+            presets = [
+                ("Last Month", "last month", month_cols[-1], "top_product_returns_last_month.csv"),
+                ("Month Before Last Month", "month before last month", month_cols[-2],
+                 "top_product_returns_month_before_last_month.csv"),
+            ]
+            for period, narration, month, file_name in presets:
+                top_alerts_df = returns[returns['Month'] == month].head(num_alerts).reset_index(drop=True)
+
+                # Handling no alerts case
+                if top_alerts_df.empty:
+                    st.subheader(f"Top {num_alerts} Product Returns {period} Alerts")
+                    st.write("No return for the selected period and/or town")
+                    continue
+
+                # Narration is only built for the alerts on display
+                top_alerts_df.insert(0, 'Alert', [
+                    f"Alert: {product} at {pharmacy} - Returns {narration}: {units} units"
+                    for pharmacy, product, units in top_alerts_df[['Pharmacy', 'Product', 'Returns']].itertuples(index=False)
+                ])
+                st.subheader(f"Top {num_alerts} Product Returns {period} Alerts")
+                for alert in top_alerts_df['Alert']:
+                    st.write(alert)  # Displaying the alert message
+
+                st.subheader(f"Top {num_alerts} Product Returns {period} Alerts Table")
+                st.table(top_alerts_df[['Pharmacy', 'Product', 'Returns']])
 
                 # Converting the DataFrame to CSV and encoding to bytes
-                csv = top_alerts_df.to_csv(index=False).encode('utf-8')
+                csv = top_alerts_df[['Alert', 'Pharmacy', 'Product', 'Returns']].to_csv(index=False).encode('utf-8')
                 st.download_button(
                     label="Download Top Product Returns CSV",
                     data=csv,
-                    file_name="top_product_returns_last_month.csv",
+                    file_name=file_name,
                     mime='text/csv'
                 )
 
-            # Repeat the adjusted logic for the month before last month section
-            # ... [Repeat the logic for the month before last month section, similar to the last month section] ...
-            # Common function to generate alerts
-            def generate_alerts(data):
-                alerts = []
-                grouped_data = data.groupby(['NAME', 'DISCRIPTION'])
-
-                for (pharmacy, product), group in grouped_data:
-                    monthly_sales = group.iloc[:, 5:]  # includes monthly last column
-                    last_month_returns = monthly_sales.iloc[:, -2]  # Focusing on the month beforelast month
-
-                    if last_month_returns.values[0] < 0:
-                        returns = abs(last_month_returns.values[0])
-                        alert_message = f"Alert: {product} at {pharmacy} - Returns month before last month: {returns} units"
-                        alerts.append((alert_message, pharmacy, product, returns))
-
-                return alerts
-
-            alerts = generate_alerts(data)
-
-            # Handling no alerts case
-            if not alerts:
-                st.subheader(f"Top {num_alerts} Product Returns For Month Before Last Month Alerts")           
+            # Any month or month range, ranked the same way
+            st.subheader("Product Returns for a Month Range")
+            start_month, end_month = st.select_slider('Select a month range for returns', options=month_cols,
+                                                      value=(month_cols[-1], month_cols[-1]))
+            range_months = month_cols[month_cols.index(start_month):month_cols.index(end_month) + 1]
+            range_returns = returns[returns['Month'].isin(range_months)].head(num_alerts).reset_index(drop=True)
+            if range_returns.empty:
                 st.write("No return for the selected period and/or town")
             else:
-                # Displaying top N alerts for narration
-                st.subheader(f"Top {num_alerts} Product Returns Month Before Last Month Alerts")
-                for alert in sorted(alerts, key=lambda x: x[3], reverse=True)[:num_alerts]:
-                    st.write(alert[0])  # Displaying the alert message
-
-                # Creating and displaying DataFrame
-                alerts_df = pd.DataFrame(alerts, columns=["Alert", "Pharmacy", "Product", "Returns"])
-                top_alerts_df = alerts_df.sort_values(by='Returns', ascending=False).head(num_alerts)
-                st.subheader(f"Top {num_alerts} Product Returns Month Before Last Month Alerts Table")
-                st.table(top_alerts_df.drop(columns="Alert"))
-
-                # Converting the DataFrame to CSV and encoding to bytes
-                csv = top_alerts_df.to_csv(index=False).encode('utf-8')
+                st.table(range_returns)
+                csv = range_returns.to_csv(index=False).encode('utf-8')
                 st.download_button(
-                    label="Download Top Product Returns CSV",
+                    label="Download Product Returns CSV",
                     data=csv,
-                    file_name="top_product_returns_month_before_last_month.csv",
+                    file_name=f"product_returns_{start_month}_to_{end_month}.csv",
                     mime='text/csv'
                 )
 
@@ -670,7 +831,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             num_pharmacies = st.number_input('Select number of top pharmacies to analyze', min_value=1, value=10, step=1)
 
             # Extract unique product descriptions and convert them to a list
-            unique_products = data['DISCRIPTION'].unique().tolist()
+            unique_products = rollups['product'].index.tolist()
 
             # Sort the list of unique products
             unique_products.sort()
@@ -681,14 +842,20 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             # Use the sorted list in the select box
             selected_product = st.selectbox('Select a Product (or choose "All Products" for all)', unique_products)
 
+            # Pharmacy and pharmacy x product monthly sales from the rollup cube
+            pharmacy_product = rollups['pharmacy_product']
+            product_positions = None
             if selected_product != 'All Products':
-                data = data[data['DISCRIPTION'] == selected_product]
+                product_positions = row_positions(row_index, DISCRIPTION=selected_product)
+                pharmacy_product = pharmacy_product[pharmacy_product.index.get_level_values('DISCRIPTION') == selected_product]
+                pharmacy_performance = pharmacy_product.droplevel('DISCRIPTION')
+            else:
+                pharmacy_performance = rollups['pharmacy']
 
             # Analysis code
-            pharmacy_performance = data.groupby('NAME').sum(numeric_only=True)
             total_dispensed_by_pharmacy = pharmacy_performance.sum(axis=1).sort_values(ascending=False)
             top_n_pharmacies = total_dispensed_by_pharmacy.nlargest(num_pharmacies)
-            monthly_trends_top_n_pharmacies = data[data['NAME'].isin(top_n_pharmacies.index)].groupby('NAME').sum(numeric_only=True)
+            monthly_trends_top_n_pharmacies = pharmacy_performance[pharmacy_performance.index.isin(top_n_pharmacies.index)]
 
             st.subheader(f'Top {num_pharmacies} Pharmacies by Unit Sales for {selected_product}')
             st.table(top_n_pharmacies)
@@ -715,8 +882,8 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             )
 
             # Top N Pharmacies Data
-            top_n_pharmacies_data = data[data['NAME'].isin(top_n_pharmacies.index)]
-            top_n_pharmacies_product_performance = top_n_pharmacies_data.groupby(['NAME', 'DISCRIPTION']).sum(numeric_only=True).sum(axis=1).unstack(fill_value=0)
+            top_n_pharmacies_data = pharmacy_product[pharmacy_product.index.get_level_values('NAME').isin(top_n_pharmacies.index)]
+            top_n_pharmacies_product_performance = top_n_pharmacies_data.sum(axis=1).unstack('DISCRIPTION', fill_value=0)
 
             st.subheader(f'Top {num_pharmacies} Pharmacies by Product')
             st.table(top_n_pharmacies_product_performance)
@@ -730,14 +897,19 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 mime='text/csv'
             )
 
-            # Pharmacies with at least a product sales
-            # Function to process data
-            months = data.columns[5:]
-            pharmacies_with_sales = data.groupby('NAME').filter(lambda x: all(x[month].sum() > 0 for month in months))
+            # Pharmacies with sales in enough months, filtered from the activity coverage of the selection
+            months = month_cols
+            coverage = pharmacy_activity(data_key, selected_product, pharmacy_performance)
 
+            # User input for the coverage threshold, e.g. 10 of 12 months
+            min_active_months = st.number_input(f'Minimum number of months with sales (of {len(months)})', min_value=1,
+                                                max_value=len(months), value=len(months))
+            coverage_desc = ("with at least one sale per month" if min_active_months == len(months)
+                             else f"with sales in at least {min_active_months} of {len(months)} months")
+            qualifying = coverage.index[coverage['Active Months'] >= min_active_months]
 
             # Calculate total and monthly sales for each of these pharmacies
-            total_and_monthly_sales = pharmacies_with_sales.groupby('NAME')[months].sum()
+            total_and_monthly_sales = pharmacy_performance.loc[qualifying].copy()
             total_and_monthly_sales['Total Sales'] = total_and_monthly_sales.sum(axis=1)
 
              # User input for top N pharmacies
@@ -745,9 +917,10 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
 
             # Filter by Top N pharmacies based on total sales within the eligible pharmacies
             top_pharmacies = total_and_monthly_sales.sort_values(by='Total Sales', ascending=False).head(top_n)
+            top_pharmacies = top_pharmacies.join(coverage)
 
             # Display the top pharmacies with their monthly and total sales
-            st.subheader(f"Top {top_n} Pharmacies by Total Unit Sales (with at least one sale per month)")
+            st.subheader(f"Top {top_n} Pharmacies by Total Unit Sales ({coverage_desc})")
             st.write(top_pharmacies)
 
             # Convert the data to a CSV for download
@@ -759,22 +932,9 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 mime='text/csv',
             )
 
-            # Define month columns
-            months = data.columns[5:]
-
-            # Identify pharmacies with at least one product sale per month
-            pharmacies_with_sales = data.groupby('NAME').filter(lambda x: all(x[month].sum() > 0 for month in months))
-
-            # Calculate total and monthly sales for each of these pharmacies
-            total_and_monthly_sales = pharmacies_with_sales.groupby('NAME')[months].sum()
-            total_and_monthly_sales['Total Sales'] = total_and_monthly_sales.sum(axis=1)
-
-            # Determine the top N pharmacies based on total sales
-            top_pharmacies = total_and_monthly_sales.sort_values(by='Total Sales', ascending=False).head(top_n)
-
             # Extract product sales data for these top pharmacies
             top_pharmacy_names = top_pharmacies.index.tolist()
-            top_pharmacies_product_sales = pharmacies_with_sales[pharmacies_with_sales['NAME'].isin(top_pharmacy_names)]
+            top_pharmacies_product_sales = data.iloc[row_positions(row_index, within=product_positions, NAME=top_pharmacy_names)]
             st.subheader(f"Top {top_n} Pharmacies by Unit Sales")
             st.write(top_pharmacies_product_sales)
 
@@ -796,9 +956,16 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             towns.insert(0, 'All Towns')  # Add 'All Towns' option
             selected_town = st.selectbox('Select Town (or choose "All Towns" for all)', towns)
 
+            # Rows selected by the town and pharmacy filters, resolved through the row index
+            full_data = data
+            positions = None
+            page_criteria = {}
+
             # Filtering data by selected town if not 'All Towns'
             if selected_town != 'All Towns':
-                data = data[data['TOWN'] == selected_town]
+                positions = row_positions(row_index, TOWN=selected_town)
+                data = full_data.iloc[positions]
+                page_criteria['TOWN'] = selected_town
 
             # User input for pharmacy selection
             pharmacies = data['NAME'].unique().tolist()  # Assuming 'NAME' column contains Pharmacy names
@@ -808,79 +975,48 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
 
             # Filtering data by selected pharmacy if not 'All Pharmacies'
             if selected_pharmacy != 'All Pharmacies':
-                data = data[data['NAME'] == selected_pharmacy]
+                positions = row_positions(row_index, within=positions, NAME=selected_pharmacy)
+                data = full_data.iloc[positions]
+                page_criteria['NAME'] = selected_pharmacy
 
             # User input for the number of top alerts
             num_alerts = st.number_input('Select number of top alerts to display', min_value=1, value=20, step=1)
 
-            # Function for generating alerts
-            def alert_sales_dip(data, num_alerts, period_desc):
-                alerts = []
-                grouped_data = data.groupby(['NAME', 'DISCRIPTION'])
-
-                for (pharmacy, product), group in grouped_data:
-                    monthly_sales = group.iloc[:, 5:] # includes monthly last column
-                    average_sales = monthly_sales.mean(axis=1)
-
-                    last_month_sales = monthly_sales.iloc[:, -1] if period_desc == "the last month" else monthly_sales.iloc[:, -2]
-                    sales_dip = average_sales.values[0] - last_month_sales.values[0]
-                    if last_month_sales.values[0] < average_sales.values[0]:
-                        sales_dip_rounded = round(sales_dip)
-                        alert_msg = f"Alert: {product} at {pharmacy} - Sales in {period_desc} for {selected_town} for {selected_pharmacy} are below the average by {sales_dip_rounded} units"
-                        alerts.append((alert_msg, sales_dip_rounded))
-
-                if not alerts:
-                    return [f"No alerts for {selected_town} in {period_desc}"], []
-
-                # Sorting and limiting alerts
-                top_alerts = sorted(alerts, key=lambda x: x[1], reverse=True)[:num_alerts]
-                alert_messages = [alert[0] for alert in top_alerts]
-                alert_data = [{"Pharmacy": alert[0].split(' at ')[1].split(' - ')[0], "Product": alert[0].split('Alert: ')[1].split(' at ')[0], "Sales Dip": alert[1]} for alert in top_alerts]
-                return alert_messages, alert_data
-
-            # Narration and dataframe for last month
-            st.header(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Narration for last month")
-            sales_alerts, alert_data = alert_sales_dip(data, num_alerts, "the last month")
-            for alert in sales_alerts:
-                st.write(alert)  # Displaying the top N alerts
-
-            alerts_df = pd.DataFrame(alert_data)
-
-            if alerts_df.empty:
-                st.write(f"No alerts for {selected_town} in the last month")
+            # Dips of every pharmacy x product against its average, for all months in one vectorized pass
+            if alert_store is not None:
+                dips = read_alerts(alert_store[0], 'dips', Month=month_cols[-2:], **page_criteria)
             else:
-                st.subheader(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Table for last month")
+                dips = find_sales_dips(data, month_cols, top_k=num_alerts)
+
+            # The last month and the month before last are presets over the same records
+            presets = [
+                ("last month", "the last month", month_cols[-1], "Last Month", "top_sales_alerts_last_month.csv"),
+                ("month before last", "the month before last", month_cols[-2], "Month Before Last",
+                 "top_sales_alerts_month_before_last.csv"),
+            ]
+            for period, period_desc, month, label, file_name in presets:
+                # Narration and dataframe for the period
+                st.header(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Narration for {period}")
+                alerts_df = dips[dips['Month'] == month].head(num_alerts).reset_index(drop=True)
+
+                if alerts_df.empty:
+                    st.write(f"No alerts for {selected_town} in {period_desc}")
+                    continue
+
+                # Narration is only built for the alerts on display
+                for pharmacy, product, sales_dip in alerts_df[['Pharmacy', 'Product', 'Sales Dip']].itertuples(index=False):
+                    st.write(f"Alert: {product} at {pharmacy} - Sales in {period_desc} for {selected_town} for {selected_pharmacy} are below the average by {sales_dip} units")
+
+                alerts_df = alerts_df[['Pharmacy', 'Product', 'Sales Dip']]
+                st.subheader(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Table for {period}")
                 st.table(alerts_df)
 
-                # CSV download button for last month
-                csv_last_month = alerts_df.to_csv(index=False).encode('utf-8')
+                # CSV download button for the period
+                csv = alerts_df.to_csv(index=False).encode('utf-8')
                 st.download_button(
-                    label="Download Top Alerts for Last Month CSV",
-                    data=csv_last_month,
-                    file_name="top_sales_alerts_last_month.csv",
-                    mime='text/csv'
-                )
-
-            # Narration and dataframe for the month before last month
-            st.header(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Narration for month before last")
-            sales_alerts, alert_data = alert_sales_dip(data, num_alerts, "the month before last")
-            for alert in sales_alerts:
-                st.write(alert)  # Displaying the top N alerts
-
-            alerts_df = pd.DataFrame(alert_data)
-
-            if alerts_df.empty:
-                st.write(f"No alerts for {selected_town} in the month before last")
-            else:
-                st.subheader(f"Top {num_alerts} Alerts for {selected_town} for {selected_pharmacy} Table for month before last")
-                st.table(alerts_df)
-
-                # CSV download button for the month before last month
-                csv_month_before_last = alerts_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Download Top Alerts for Month Before Last CSV",
-                    data=csv_month_before_last,
-                    file_name="top_sales_alerts_month_before_last.csv",
+                    label=f"Download Top Alerts for {label} CSV",
+                    data=csv,
+                    file_name=file_name,
                     mime='text/csv'
                 )
 
@@ -907,15 +1043,15 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 selected_products = ['All Products']
 
             # Filter DataFrame based on selections
-            filtered_df = df[df['NAME'] == selected_pharmacy]
+            filtered_positions = row_positions(row_index, within=positions, NAME=selected_pharmacy)
 
             # Check if 'All Products' is selected
             if 'All Products' in selected_products:
                 # Do not filter by products
-                filtered_df = filtered_df
+                filtered_df = full_data.iloc[filtered_positions]
             else:
                 # Filter by selected products
-                filtered_df = filtered_df[filtered_df['DISCRIPTION'].isin(selected_products)]
+                filtered_df = full_data.iloc[row_positions(row_index, within=filtered_positions, DISCRIPTION=selected_products)]
 
             # Display the filtered DataFrame
             st.write('Filtered Data:', filtered_df)
@@ -935,60 +1071,55 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             # Streamlit User Interface
             st.subheader("Two or More Consecutive Drop in Unit Sales")
 
-            # Ensure tqdm is patched into pandas
-            tqdm.pandas()
-
             # User input for the percentage drop
             percentage_drop = st.number_input("Enter the percentage drop for alert (e.g., 25 for 25%)", min_value=10, value=25, max_value=30)
             drop_threshold = -percentage_drop / 100
 
-            # Convert all sales columns to numeric, coercing errors to NaN
-            sales_cols = df.columns[df.columns.str.contains('-')]
-            df[sales_cols] = df[sales_cols].apply(pd.to_numeric, errors='coerce')
-
-            # Define a function to check for two or more consecutive drops in sales
-            def check_consecutive_drops(row):
-                # Calculate the percentage change between months
-                changes = row[sales_cols].pct_change().fillna(0)
-                # Identify the drops
-                drops = (changes <= drop_threshold)
-                # Check for two or more consecutive drops
-                if drops.sum() >= 2:
-                    # Extract months with drops
-                    drop_months = drops.index[drops].tolist()
-                    return ', '.join(drop_months)
-                return None
+            # User input for the length of the run of drops
+            min_run = st.number_input("Minimum number of consecutive drops", min_value=2, value=2, step=1)
 
             # Dropdown for product selection
             product_list = sorted(df['DISCRIPTION'].unique())  # Extract unique product descriptions and sort
+            product_list.insert(0, 'All Products')  # Adding an option for a national report
             selected_product = st.selectbox("Select a Product", product_list)
 
             # Dropdown for town selection
             town_list = df['TOWN'].dropna().astype(str).unique().tolist()  # Convert to string and drop NaNs
             town_list.sort()  # Sort the list of towns
+            town_list.insert(0, 'All Towns')  # Adding an option for a national report
             selected_town = st.selectbox("Select a Town", town_list, key="town_selection_key")
 
             # Filter the DataFrame by 'DISCRIPTION' and 'TOWN'
-            filtered_df = df[(df['DISCRIPTION'] == selected_product) & (df['TOWN'] == selected_town)]
-
-            # Apply the function across the rows and filter the DataFrame
-            filtered_df['Drop Months'] = filtered_df.progress_apply(check_consecutive_drops, axis=1)
-            final_filtered_df = filtered_df.dropna(subset=['Drop Months'])
+            criteria = {}
+            if selected_product != 'All Products':
+                criteria['DISCRIPTION'] = selected_product
+            if selected_town != 'All Towns':
+                criteria['TOWN'] = selected_town
+            filtered_df = full_data.iloc[row_positions(row_index, within=positions, **criteria)] if criteria else data
+
+            # Month-over-month changes and runs of drops for every selected row at once, unless the
+            # batch job already stored them for the same drop settings
+            if (alert_store is not None and float(alert_store[1]['drop_percent']) == percentage_drop
+                    and int(alert_store[1]['min_run']) == min_run):
+                # A section filter that contradicts the page filter selects nothing
+                store_criteria = dict(page_criteria)
+                for column, value in criteria.items():
+                    store_criteria[column] = value if store_criteria.get(column, value) == value else []
+                final_filtered_df = read_alerts(alert_store[0], 'drops', **store_criteria)
+            else:
+                final_filtered_df = find_consecutive_drops(filtered_df, month_cols, drop_threshold, min_run)
 
             # Handling empty DataFrame
             if final_filtered_df.empty:
                 st.write("No results found for the selected criteria.")
             else:
-                # Construct and display a narrative for each customer with drops
-                for _, row in final_filtered_df.iterrows():
-                    customer = row['NAME']  # Assuming 'CUSTOMER' is the column name for customer details
-                    drop_months = row['Drop Months']
-                    st.write(f"Customer {customer} for {selected_product} in {selected_town} experienced a sales drop of at least {percentage_drop}% during these consecutive months: {drop_months}.")
+                # Construct and display a narrative for the customers with the longest runs of drops
+                for customer, product, town, drop_months in final_filtered_df[['NAME', 'DISCRIPTION', 'TOWN', 'Drop Months']].head(num_alerts).itertuples(index=False):
+                    st.write(f"Customer {customer} for {product} in {town} experienced a sales drop of at least {percentage_drop}% during these consecutive months: {drop_months}.")
+                if len(final_filtered_df) > num_alerts:
+                    st.caption(f"Showing {num_alerts} of {len(final_filtered_df)} customers; all are in the table below.")
 
-                try:
-                    final_filtered_df = final_filtered_df.drop(columns=['P-CODE', 'C-CODE', 'Drop Months'])
-                except KeyError as e:
-                    print("Columns not found in DataFrame: ", e)
+                final_filtered_df = final_filtered_df.drop(columns=['P-CODE', 'C-CODE'], errors='ignore')
 
                 # Display the filtered DataFrame
                 st.write(final_filtered_df)
@@ -1009,44 +1140,41 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             st.subheader("Sales Forecasting")
             # User selects a product
             # Extracting all product names
-            all_products = sorted(data['DISCRIPTION'].unique().tolist())
+            all_products = sorted(rollups['product'].index.tolist())
             selected_product = st.selectbox('Select a Product for Forecasting', all_products)
 
-            # Filtering data for a specific product
-            product_data = data[data['DISCRIPTION'] == selected_product]
-
-            # Summing up monthly sales data for the selected product
-            monthly_sales = product_data.iloc[:, 6:].sum()
+            # Monthly sales of the selected product over every month, as a time series, from the rollup cube
+            monthly_sales = product_series(rollups['product'], selected_product)
 
-            # Converting the data into a time series format
-            monthly_sales.index = pd.to_datetime(monthly_sales.index, format='%b-%y')
-
-            # Sort index in case it's out of order
-            monthly_sales = monthly_sales.sort_index()
-
-            # Auto ARIMA model (assuming no seasonality)
-            auto_model = auto_arima(monthly_sales, seasonal=False, trace=True)
+            # ARIMA engines fit one series at a time; exponential smoothing fits any number of series at once.
+            # Seasonal ARIMA captures yearly cycles with Fourier regressors instead of a slow seasonal search
+            engine = st.radio('Forecasting engine', list(ARIMA_ENGINES) + ['Exponential smoothing'], horizontal=True)
+            if engine == 'Exponential smoothing':
+                smoothing_method = st.selectbox('Smoothing method', list(SMOOTHING_METHODS), index=2)
+            else:
+                # ARIMA model fitted once per product, kind and series and reused from the model cache
+                # on slider moves, by other sessions and after restarts
+                auto_model = forecast_model(selected_product, series_fingerprint(monthly_sales), ARIMA_ENGINES[engine],
+                                            monthly_sales)
 
-            # Auto ARIMA model (assuming no seasonality)
-            if 'auto_model' not in st.session_state or st.session_state.selected_product != selected_product:
-                # Update the session state
-                st.session_state.auto_model = auto_arima(monthly_sales, seasonal=False, trace=True)
-                st.session_state.selected_product = selected_product
-                
             # Forecasting
             forecast_periods = st.slider('Select number of months to forecast', 1, 12, 3)
-            forecast = auto_model.predict(n_periods=forecast_periods)
+            if engine == 'Exponential smoothing':
+                forecast = smoothing_forecast(monthly_sales.to_numpy(), forecast_periods, smoothing_method)['forecast'][0]
+            else:
+                forecast = pd.Series(np.asarray(auto_model.predict(n_periods=forecast_periods)),
+                                     index=pd.date_range(monthly_sales.index[-1], periods=forecast_periods + 1, freq='MS')[1:])
 
             # Format the forecast to whole numbers
             forecast_rounded = np.round(forecast).astype(int)
             
             # Create a DataFrame from the forecast data
-            data = {
+            forecast_data = {
                 "Month": [f"Month {i+1}" for i in range(forecast_periods)],
                 "Forecast (Rounded)": forecast_rounded,
                 "Original Forecast": [f"{forecast[i]:.2f}" for i in range(forecast_periods)]
             }
-            df = pd.DataFrame(data)
+            df = pd.DataFrame(forecast_data)
 
             # Convert the DataFrame to CSV
             csv = df.to_csv(index=False)
@@ -1063,112 +1191,209 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 mime='text/csv',
             )
             
-            st.subheader("Model Evaluation")
-            # Check for NaN values in monthly_sales
-            if monthly_sales.isna().any():
-                st.write("Handling NaN values in monthly sales data.")
-                monthly_sales.fillna(method='ffill', inplace=True)  # Forward fill as an example
+            # National -> town -> pharmacy forecasts of the selected product, reconciled so the levels add up
+            st.subheader(f"Hierarchical Forecast for {selected_product}")
+            hierarchy_method = st.selectbox('Smoothing method for the hierarchy', list(SMOOTHING_METHODS), index=2)
+            reconciliation = st.selectbox('Reconciliation', RECONCILIATION_METHODS, index=2)
+            # Rows without a town or pharmacy get an explicit 'Unknown' node; grouping the categorical
+            # columns directly would drop them and the national level would miss their sales
+            product_rows = data.iloc[row_positions(row_index, DISCRIPTION=selected_product)]
+            hierarchy_keys = [product_rows[column].astype(object).fillna('Unknown') for column in ['TOWN', 'NAME']]
+            pharmacy_sales = product_rows.groupby(hierarchy_keys)[month_cols].sum()
+            hierarchy = hierarchical_forecast(pharmacy_sales, forecast_periods, hierarchy_method, reconciliation)
+
+            hierarchy_level = st.radio('Show', ['National and towns', 'Pharmacies'], horizontal=True)
+            shown = hierarchy['Level'] != 'Pharmacy' if hierarchy_level == 'National and towns' else hierarchy['Level'] == 'Pharmacy'
+            st.dataframe(hierarchy[shown].round(1), hide_index=True)
+            st.download_button(
+                label="Download hierarchical forecast as CSV",
+                data=hierarchy.to_csv(index=False),
+                file_name='hierarchical_forecast.csv',
+                mime='text/csv',
+            )
+
+            # Prediction intervals and stock recommendations for every product from simulated demand paths
+            st.subheader("Prediction Intervals and Safety Stock")
+            lead_time = st.number_input('Replenishment lead time (months)', min_value=1, max_value=12, value=2)
+            service_level = st.slider('Service level', 0.80, 0.99, 0.95, 0.01)
+            n_paths = st.number_input('Simulated demand paths per product', min_value=500, max_value=20000, value=5000, step=500)
+            stock_plan = product_stock_plan(data_key, forecast_periods, lead_time, service_level, n_paths, rollups['product'])
+
+            st.write(f"Demand percentiles and stock recommendation for {selected_product}:")
+            st.dataframe(stock_plan[stock_plan['Product'] == selected_product], hide_index=True)
+            st.write("All products:")
+            st.dataframe(stock_plan, hide_index=True)
+            st.download_button(
+                label="Download safety stock plan as CSV",
+                data=stock_plan.to_csv(index=False),
+                file_name='safety_stock_plan.csv',
+                mime='text/csv',
+            )
 
-#             # Assuming monthly_sales is a Pandas Series or a list containing your entire time series data
-#             # Slice the last 'forecast_periods' months from monthly_sales
-#             actual_values = np.array(monthly_sales[-forecast_periods:])
+            # Batch mode: the same model for every product, fitted in parallel worker processes for
+            # auto ARIMA, or in one vectorized pass, down to pharmacy x product level, for smoothing
+            st.subheader("Forecast All Products")
+            if engine == 'Exponential smoothing':
+                forecast_level = st.selectbox('Forecast level', ['Product', 'Pharmacy x product'])
+                level_rollup = rollups['product'] if forecast_level == 'Product' else rollups['pharmacy_product']
+                if st.button(f'Forecast all {len(level_rollup)} series'):
+                    with st.spinner('Fitting forecast models...'):
+                        st.session_state.batch_forecast = smoothing_catalogue(level_rollup, forecast_periods,
+                                                                              smoothing_method)
+            else:
+                fit_timeout = st.number_input('Seconds allowed per product before falling back to ARIMA(0,1,1)',
+                                              min_value=1, value=30, step=5)
+                if st.button(f'Forecast all {len(all_products)} products'):
+                    progress_bar = st.progress(0.0, text='Fitting forecast models...')
+                    st.session_state.batch_forecast = forecast_catalogue(
+                        rollups['product'], forecast_periods, fit_timeout, kind=ARIMA_ENGINES[engine],
+                        progress=lambda done, total: progress_bar.progress(done / total, text=f'Fitted {done} of {total} products'))
+                    progress_bar.empty()
+
+            if 'batch_forecast' in st.session_state:
+                batch_forecast = st.session_state.batch_forecast
+                st.write(f'Forecasts and in-sample errors for {len(batch_forecast)} series:')
+                st.dataframe(batch_forecast)
+                st.download_button(
+                    label="Download all product forecasts as CSV",
+                    data=batch_forecast.to_csv(index=False),
+                    file_name='forecast_all_products.csv',
+                    mime='text/csv',
+                )
+
+            # Out-of-sample accuracy: refit every engine at past forecast origins and score the held-out months
+            st.subheader("Model Evaluation")
+            backtest_origins = st.number_input('Number of forecast origins to backtest', min_value=1, max_value=6, value=3)
+            backtest_engines = st.multiselect('Engines to compare', BACKTEST_ENGINES, default=BACKTEST_ENGINES)
+            backtest_scope = st.radio('Backtest scope', ['Selected product', 'All products'], horizontal=True)
+            if st.button('Run backtest') and backtest_engines:
+                backtest_products = [selected_product] if backtest_scope == 'Selected product' else all_products
+                progress_bar = st.progress(0.0, text='Backtesting...')
+                results = rolling_origin_backtest(
+                    {product: product_series(rollups['product'], product) for product in backtest_products},
+                    forecast_periods, backtest_origins, backtest_engines,
+                    progress=lambda done, total: progress_bar.progress(done / total, text=f'Backtested {done} of {total} origins'))
+                progress_bar.empty()
+                scope_desc = selected_product if backtest_scope == 'Selected product' else f'{len(backtest_products)} products'
+                st.session_state.backtest = (scope_desc, results)
+
+            if 'backtest' in st.session_state:
+                scope_desc, results = st.session_state.backtest
+                if results.empty:
+                    st.write("Not enough months of history to backtest this horizon.")
+                else:
+                    summary = backtest_summary(results)
+                    st.write(f"Out-of-sample errors for {scope_desc} over {results['Origin'].nunique()} origins, "
+                             f"by months ahead:")
+                    st.table(summary.pivot(index='Horizon', columns='Engine', values='MAE').add_suffix(' MAE'))
+
+                    # Errors of the engine chosen above, over every horizon
+                    page_engine = engine if engine in ARIMA_ENGINES else f'{smoothing_method} smoothing'
+                    engine_results = results[results['Engine'] == page_engine]
+                    if not engine_results.empty:
+                        mae, rmse, mape = forecast_errors(engine_results['Actual'].to_numpy(), engine_results['Forecast'].to_numpy())
+                        st.metric("Mean Absolute Error", f"{mae:.2f}")
+                        st.metric("Mean Squared Error", f"{rmse ** 2:.2f}")
+                        st.metric("Root Mean Squared Error", f"{rmse:.2f}")
+                        st.metric("Mean Absolute Percentage Error", f"{mape:.2f}%")
+
+                    st.dataframe(summary)
+                    st.download_button(
+                        label="Download backtest results as CSV",
+                        data=results.to_csv(index=False),
+                        file_name='forecast_backtest.csv',
+                        mime='text/csv',
+                    )
 
-#             # Ensure forecast is a numpy array
-#             forecast_values = np.array(forecast)  # Your forecasted sales data
-            
-#             if len(actual_values) != len(forecast_values):
-#             # Option 1: Truncate the longer array (example)
-#             min_length = min(len(actual_values), len(forecast_values))
-#             actual_values = actual_values[:min_length]
-#             forecast_values = forecast_values[:min_length]
-
-            # Ensure forecast_periods is an integer and not larger than the length of monthly_sales
-            forecast_periods = min(forecast_periods, len(monthly_sales))
-
-            # Slice the last 'forecast_periods' months from monthly_sales
-            actual_values = np.array(monthly_sales[-forecast_periods:])
-
-            # Ensure forecast is a numpy array and has the same length as forecast_periods
-            forecast_values = np.array(forecast[:forecast_periods])
-
-            # Check if lengths match
-            if len(actual_values) != len(forecast_values):
-                raise ValueError(f"Length mismatch: actual_values has {len(actual_values)} elements, "
-                                 f"forecast_values has {len(forecast_values)} elements.")
-
-            # Calculate the metrics
-            mae = mean_absolute_error(actual_values, forecast_values)
-            mse = mean_squared_error(actual_values, forecast_values)
-            rmse = np.sqrt(mse)
-            mape = np.mean(np.abs((actual_values - forecast_values) / (actual_values + np.finfo(float).eps))) * 100
-
-            # Display the metrics in Streamlit
-            st.metric("Mean Absolute Error", f"{mae:.2f}")
-            st.metric("Mean Squared Error", f"{mse:.2f}")
-            st.metric("Root Mean Squared Error", f"{rmse:.2f}")
-            st.metric("Mean Absolute Percentage Error", f"{mape:.2f}%")
-               
         elif options == 'Market Segmentation':
             st.subheader("Market Segmentation")
             
+            # A saved segmentation lets later uploads carry only the new invoices
+            path = segmentation_path()
+            saved = saved_segmentation(os.path.getmtime(path)) if os.path.isfile(path) else None
+            if saved is not None:
+                st.caption(f"Saved segmentation: {len(saved['totals']):,} customers in {saved['model'].n_clusters} clusters, "
+                           f"invoices up to {(saved['latest_date'] - pd.Timedelta(days=1)):%d/%m/%Y}")
+                upload_mode = st.radio("The uploaded file holds", ['Full invoice history', 'New invoices since the saved segmentation'],
+                                       horizontal=True)
+            else:
+                upload_mode = 'Full invoice history'
+
             uploaded_file = st.file_uploader("Choose a CSV file", type="csv", key="dataload")
             
             if uploaded_file is not None:
-                data = load_data(uploaded_file)
-                data.columns = data.columns.str.strip()
-                if data is not None and 'Invoice Date' in data.columns:
-                    # Now that we have confirmed the data is loaded and the column exists,
-                    # we can proceed with the rest of the code that uses 'Invoice Date'
+                totals = load_invoice_totals(uploaded_file)
+                if totals is not None:
                     try:
-                        # ... Perform further operations with 'data' ...
-                        # RFM Analysis
-                        latest_date = data['Invoice Date'].max() + dt.timedelta(days=1)
-                        rfm = data.groupby('Name').agg({
-                            'Invoice Date': lambda x: (latest_date - x.max()).days,
-                            'Name': 'count',
-                            'Units Sold': 'sum'
-                        }).rename(columns={'Invoice Date': 'Recency', 
-                                        'Name': 'Frequency', 
-                                        'Units Sold': 'MonetaryValue'})
-
-                        # Scale the data
-                        scaler = StandardScaler()
-                        rfm_scaled = scaler.fit_transform(rfm)
-
-                        # Determine the optimal number of clusters
-                        inertia = []
-                        for k in range(1, 11):
-                            kmeans = KMeans(n_clusters=k, random_state=0)
-                            kmeans.fit(rfm_scaled)
-                            inertia.append(kmeans.inertia_)
-
-                        # Plotting the Elbow Method
-                        st.write("Elbow Method to Determine Optimal Clusters:")
-                        plt.figure(figsize=(10, 6))
-                        # Create a figure and axis object
-                        fig, ax = plt.subplots()
-                        ax.scatter([1, 2, 3], [1, 2, 3])
-                        plt.plot(range(1, 11), inertia, marker='o')
-                        plt.title('The Elbow Method')
-                        plt.xlabel('Number of clusters')
-                        plt.ylabel('Inertia')
-                        st.pyplot(fig)
+                        if upload_mode == 'Full invoice history':
+                            # RFM Analysis
+                            rfm = rfm_table(totals)
+
+                            # Scale the data
+                            scaler = StandardScaler()
+                            rfm_scaled = scaler.fit_transform(rfm)
+
+                            # Determine the optimal number of clusters; mini-batch k-means keeps
+                            # the sweep quick on large customer bases
+                            algorithm = st.radio("Clustering algorithm", ['K-Means', 'Mini-batch K-Means'],
+                                                 index=int(len(rfm) >= MINIBATCH_THRESHOLD), horizontal=True)
+                            rfm_key = hashlib.sha256(rfm_scaled.tobytes()).hexdigest()
+                            sweep, cluster_models = segment_sweep(rfm_key, algorithm == 'Mini-batch K-Means', rfm_scaled)
+
+                            # Plotting the Elbow Method
+                            st.write("Elbow Method to Determine Optimal Clusters:")
+                            plt.figure(figsize=(10, 6))
+                            # Create a figure and axis object
+                            fig, ax = plt.subplots()
+                            plt.plot(sweep['Clusters'], sweep['Inertia'], marker='o')
+                            plt.title('The Elbow Method')
+                            plt.xlabel('Number of clusters')
+                            plt.ylabel('Inertia')
+                            st.pyplot(fig)
+
+                            # Finding the elbow point, with a sampled silhouette estimate per number of clusters
+                            optimal_clusters = choose_clusters(sweep)
+                            st.write(f"Optimal Number of Clusters: {optimal_clusters}")
+                            st.dataframe(sweep.set_index('Clusters').style.format({'Inertia': '{:,.1f}', 'Silhouette': '{:.3f}'}))
+
+                            st.title('Customer Segment Grouping')
+
+                            # Reuse the sweep's model for the optimal number of clusters
+                            rfm['Cluster'] = cluster_models[optimal_clusters].labels_
+                            state = segmentation_state(totals, scaler, cluster_models[optimal_clusters], rfm['Cluster'].to_numpy())
+                        else:
+                            # Update only the customers in the new invoices and reassign them with the saved model;
+                            # a batch already in the saved segmentation (e.g. after saving it) is not merged again
+                            if batch_applied(saved, totals):
+                                st.info("These invoices are already part of the saved segmentation.")
+                                state = saved
+                            else:
+                                try:
+                                    state = update_segmentation(saved, totals)
+                                except ValueError as e:
+                                    st.error(str(e))
+                                    st.stop()
+                            rfm = segmented_rfm(state)
+                            drift = segmentation_drift(state)
+
+                            st.title('Customer Segment Grouping')
+                            col1, col2, col3 = st.columns(3)
+                            col1.metric("Customers updated", f"{len(totals):,}")
+                            col2.metric("New customers since the fit", f"{state['new_customers']:,}")
+                            col3.metric("Cluster drift", f"{drift:.2f}", help="Mean squared distance of customers to their "
+                                        "cluster centre relative to when the clusters were fitted")
+                            if drift > DRIFT_THRESHOLD:
+                                st.warning("The clusters no longer fit the customer base well; "
+                                           "upload the full invoice history to recluster.")
+
+                        if st.button("Save segmentation for incremental updates"):
+                            save_segmentation(state)
+                            st.success("Segmentation saved.")
 
-                        # Finding the elbow point
-                        kl = KneeLocator(range(1, 11), inertia, curve='convex', direction='decreasing')
-                        optimal_clusters = kl.elbow
-                        st.write(f"Optimal Number of Clusters: {optimal_clusters}")
-                        
-                        st.title('Customer Segment Grouping')
-                        
-                       # K-Means clustering with optimal clusters
-                        kmeans = KMeans(n_clusters=optimal_clusters, random_state=0)
-                        rfm['Cluster'] = kmeans.fit_predict(rfm_scaled)
                         rfm = rfm.sort_values(by='Cluster')
                         
-                        rfm['RFM_SCORE'] = rfm['Recency'].astype('int') + rfm['Frequency'].astype('int') + rfm['MonetaryValue'].astype('int') 
-                        rfm['RFM Customer Segments'] = rfm.apply(cluster_segments,axis=1) 
-                        rfm['RFM Customer Segments'] 
+                        rfm['RFM_SCORE'] = rfm_scores(rfm)
+                        rfm['RFM Customer Segments'] = segment_labels(rfm['RFM_SCORE'])
                         
                         # Reset the index to turn 'Name' from an index into a column
                         rfm = rfm.reset_index()
@@ -1249,32 +1474,28 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                         # Display the treemap chart in Streamlit
                         st.plotly_chart(fig)
                                             
-                        # Create a new figure for 3D plotting
-                        fig = plt.figure()
-                        ax = fig.add_subplot(111, projection='3d')
-
-                        # Plot data
-                        # Assuming 'MonetaryValue' is your third dimension
-                        sc = ax.scatter(rfm['Recency'], rfm['Frequency'], rfm['MonetaryValue'], c=rfm['Cluster'], cmap='viridis')
-
-                        # Set labels and title
-                        ax.set_xlabel('Recency')
-                        ax.set_ylabel('Frequency')
-                        ax.set_zlabel('Monetary Value')
-                        ax.set_title('RFM Customer Segments 3D')
-                        
-                        # Adjust legend
-                        # Create a legend and place it outside the plot area
-                        legend = ax.legend(*sc.legend_elements(), title='Cluster', loc='center left', bbox_to_anchor=(1.2, 0.5))
-
-                        # Show plot
-                        st.pyplot(fig)
+                        # Interactive 3D view, rendered in the browser from at most a point budget of customers
+                        col1, col2 = st.columns(2)
+                        point_budget = col1.number_input("Points in the 3D chart", min_value=100, value=SCATTER_BUDGET, step=1000)
+                        sampling = col2.radio("Sampling above the budget", ['Cluster-stratified', 'Density-aware'], horizontal=True)
+                        shown = scatter_sample(rfm, int(point_budget), 'stratified' if sampling == 'Cluster-stratified' else 'density')
+                        if len(shown) < len(rfm):
+                            st.caption(f"Showing {len(shown):,} of {len(rfm):,} customers.")
+
+                        fig = px.scatter_3d(shown, x='Recency', y='Frequency', z='MonetaryValue',
+                                            color=shown['Cluster'].astype(str), hover_name='Name',
+                                            hover_data=['RFM Customer Segments'],
+                                            labels={'MonetaryValue': 'Monetary Value', 'color': 'Cluster'},
+                                            category_orders={'color': [str(c) for c in sorted(rfm['Cluster'].unique())]})
+                        fig.update_traces(marker=dict(size=3))
+                        fig.update_layout(title='RFM Customer Segments 3D')
+                        st.plotly_chart(fig)
                         
                         
                     except TypeError as e:
                         st.error(f"TypeError encountered: {e}")
                 else:
-                    st.error("The uploaded file does not contain an 'Invoice Date' column or failed to load correctly.")
+                    st.error("The uploaded file does not contain the Name, 'Invoice Date' and 'Units Sold' columns or failed to load correctly.")
             else:
                 st.write("Please upload a CSV file.")
                 
@@ -1285,7 +1506,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             st.markdown("<h1 style='font-size:30px;'>Voice of the Customer: Sentiment Analysis</h1>", unsafe_allow_html=True)
 
             if filename is not None:
-                data = pd.read_csv(filename, encoding="utf-8")  # Assuming CSV file format
+                data = read_uploaded_csv(filename, encoding="utf-8")  # Assuming CSV file format
                 data["body"] = data["body"].astype("str")
 
                 # Apply VADER sentiment analysis
@@ -1383,7 +1604,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             uploaded_file = st.file_uploader("Upload your CSV file with periodic data", type="csv")
             if uploaded_file is not None:
                 # Read data
-                data = pd.read_csv(uploaded_file)
+                data = read_uploaded_csv(uploaded_file)
 
                 # Check if the CSV has the expected columns: 'Period' and 'Score'
                 if 'Period' in data.columns and 'Score' in data.columns:
@@ -1414,7 +1635,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             # Assume the data is loaded and available as 'data'
             uploaded_file = st.file_uploader("Upload your CSV file", type=['csv'])
             if uploaded_file is not None:
-                data = pd.read_csv(uploaded_file)
+                data = read_uploaded_csv(uploaded_file)
                 st.session_state.data = data  # Saving data to session state for persistent access
 
             # Check if data is loaded
@@ -1516,7 +1737,7 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
                 uploaded_file = st.file_uploader("Upload your stocks CSV file", type=["csv"], key="file_uploader")
                 if uploaded_file is not None:
                     # Load and store the data in the session state
-                    data = pd.read_csv(uploaded_file)
+                    data = read_uploaded_csv(uploaded_file)
                     # Strip potential extra spaces in column names
                     data.columns = data.columns.str.strip()
                     st.session_state.expiry_data = data
@@ -1567,5 +1788,5 @@ if username_guess == st.secrets["username"] and password_guess == st.secrets["pa
             
 
     else:
-        st.warning('Please upload a CSV file to proceed.')
+        st.warning('Please upload a CSV file or select a published dataset to proceed.')
 
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Vectorized alert engines for the wide pharmacy x product sales sheet.
+
+Run as a script to precompute the alerts of a published dataset for every
+town, pharmacy and product into a local SQLite store that the dashboard reads:
+
+    python sales_alerts.py <dataset> [--workers N] [--drop-percent 25] [--min-run 2]
+
+With --check it instead compares the dataset's running statistics, and the
+newest month's dips computed from them, with a full recompute.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from sales_data import (DATASET_DIR, month_columns, dataset_path, dataset_version, read_dataset,
+                        build_running_stats, read_running_stats)
+
+ALERTS_FILE = 'alerts.sqlite'
+
+# Columns of each stored alert table that hold the town, pharmacy and product
+ALERT_KEYS = {
+    'returns': {'TOWN': 'Town', 'NAME': 'Pharmacy', 'DISCRIPTION': 'Product'},
+    'dips': {'TOWN': 'Town', 'NAME': 'Pharmacy', 'DISCRIPTION': 'Product'},
+    'drops': {'TOWN': 'TOWN', 'NAME': 'NAME', 'DISCRIPTION': 'DISCRIPTION'},
+}
+
+
+def month_matrix(data, months):
+    """Returns the month columns as one 2-D array, widened so arithmetic cannot overflow."""
+    values = data[months].to_numpy()
+    return values.astype('int64') if values.dtype.kind in 'iu' else values.astype('float64')
+
+
+def find_returns(data, months=None):
+    """Finds every return (negative quantity) in the given months in one pass over the sheet.
+
+    Returns one record per returned pharmacy x product x month cell with the
+    Pharmacy, Product, Town, Month and Returns (units, as a positive number),
+    ranked by Returns with ties in pharmacy and product order.
+    """
+    months = month_columns(data.columns) if months is None else list(months)
+    values = month_matrix(data, months)
+    rows, columns = np.nonzero(values < 0)
+
+    returns = pd.DataFrame({
+        'Pharmacy': data['NAME'].iloc[rows].to_numpy(),
+        'Product': data['DISCRIPTION'].iloc[rows].to_numpy(),
+        'Town': data['TOWN'].iloc[rows].to_numpy(),
+        'Month': np.asarray(months, dtype=object)[columns],
+        'Returns': -values[rows, columns],
+    })
+    return returns.sort_values(['Returns', 'Pharmacy', 'Product'], ascending=[False, True, True],
+                               kind='stable').reset_index(drop=True)
+
+
+def find_sales_dips(data, months=None, reference_months=None, top_k=None):
+    """Finds every pharmacy x product whose sales in a reference month fell below its average.
+
+    The average over all months is compared with every reference month (all
+    months by default) at once. Returns one record per dip with the Pharmacy,
+    Product, Town, Month, Average, Sales and Sales Dip (rounded units), ranked
+    by Sales Dip with ties in month, pharmacy and product order. With top_k,
+    only the top_k largest dips of each reference month (plus ties) are kept.
+    """
+    months = month_columns(data.columns) if months is None else list(months)
+    reference_months = months if reference_months is None else list(reference_months)
+    values = month_matrix(data, months)
+    average = values.mean(axis=1)
+
+    frames = [_dip_records(data, average, values[:, months.index(month)], month, top_k)
+              for month in reference_months]
+    return _rank_dips(frames)
+
+
+def dips_from_running_stats(stats, month, top_k=None):
+    """Finds the sales dips of the newest month from running statistics, without reading earlier months.
+
+    ``stats`` are the running statistics kept up to date by ``append_month``;
+    the records are the same as ``find_sales_dips`` gives for that month.
+    """
+    average = stats['Sum'].to_numpy() / stats['Count'].to_numpy()
+    return _rank_dips([_dip_records(stats, average, stats['Recent 1'].to_numpy(), month, top_k)])
+
+
+def _dip_records(data, average, sales, month, top_k):
+    rows = np.flatnonzero(sales < average)
+    dips = np.rint(average[rows] - sales[rows]).astype('int64')
+
+    # Bounded selection: only rows at or above the k-th largest dip are ranked
+    if top_k is not None and len(rows) > top_k:
+        kth = np.partition(dips, len(dips) - top_k)[len(dips) - top_k]
+        keep = dips >= kth
+        rows, dips = rows[keep], dips[keep]
+
+    return pd.DataFrame({
+        'Pharmacy': data['NAME'].iloc[rows].to_numpy(),
+        'Product': data['DISCRIPTION'].iloc[rows].to_numpy(),
+        'Town': data['TOWN'].iloc[rows].to_numpy(),
+        'Month': month,
+        'Average': average[rows],
+        'Sales': sales[rows],
+        'Sales Dip': dips,
+    })
+
+
+def _rank_dips(frames):
+    if not frames:
+        return pd.DataFrame(columns=['Pharmacy', 'Product', 'Town', 'Month', 'Average', 'Sales', 'Sales Dip'])
+    dips = pd.concat(frames, ignore_index=True)
+    return dips.sort_values(['Sales Dip', 'Pharmacy', 'Product'], ascending=[False, True, True],
+                            kind='stable').reset_index(drop=True)
+
+
+def month_over_month_changes(values):
+    """Returns the month-over-month fractional change of every row, like pct_change with 0 for the first month."""
+    changes = np.zeros(values.shape, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        changes[:, 1:] = (values[:, 1:] - values[:, :-1]) / values[:, :-1]
+    changes[np.isnan(changes)] = 0
+    return changes
+
+
+def run_lengths(flags):
+    """Returns, for every True cell of a 2-D boolean array, the length of the row-wise run it belongs to."""
+    n_months = flags.shape[1]
+    position = np.arange(n_months)
+
+    # Cells since the last False looking forward, and until the next False looking backward
+    last_false = np.maximum.accumulate(np.where(flags, -1, position), axis=1)
+    next_false = np.minimum.accumulate(np.where(flags, n_months, position)[:, ::-1], axis=1)[:, ::-1]
+    return np.where(flags, next_false - last_false - 1, 0)
+
+
+def find_consecutive_drops(data, months=None, threshold=-0.25, min_run=2):
+    """Finds the rows whose sales dropped by threshold or more for min_run or more consecutive months.
+
+    Month-over-month changes are computed for the whole matrix at once. Returns
+    the matching rows of data with 'Drop Months' (the months inside qualifying
+    runs) and 'Longest Run' added, longest runs first.
+    """
+    months = month_columns(data.columns) if months is None else list(months)
+    drops = month_over_month_changes(month_matrix(data, months)) <= threshold
+    lengths = run_lengths(drops)
+    in_run = lengths >= min_run
+    rows = np.flatnonzero(in_run.any(axis=1))
+
+    month_names = np.asarray(months, dtype=object)
+    result = data.iloc[rows].copy()
+    result['Drop Months'] = [', '.join(month_names[in_run[row]]) for row in rows]
+    result['Longest Run'] = lengths[rows].max(axis=1)
+    return result.sort_values('Longest Run', ascending=False, kind='stable')
+
+
+def activity_coverage(monthly):
+    """Summarises in which months each row of a row x month sales frame had sales.
+
+    Returns the Active Months count, the Longest Streak of consecutive active
+    months and the First Active and Last Active month for every row.
+    """
+    month_names = np.asarray(monthly.columns, dtype=object)
+    active = monthly.to_numpy() > 0
+    any_active = active.any(axis=1)
+    first = active.argmax(axis=1)
+    last = len(month_names) - 1 - active[:, ::-1].argmax(axis=1)
+
+    return pd.DataFrame({
+        'Active Months': active.sum(axis=1),
+        'Longest Streak': run_lengths(active).max(axis=1, initial=0),
+        'First Active': np.where(any_active, month_names[first], None),
+        'Last Active': np.where(any_active, month_names[last], None),
+    }, index=monthly.index)
+
+
+def town_alerts(data, months, drop_threshold, min_run):
+    """Computes the returns, sales dips and consecutive drops of one partition of the sheet."""
+    drops = find_consecutive_drops(data, months, drop_threshold, min_run)
+    return (find_returns(data, months), find_sales_dips(data, months),
+            drops.drop(columns=['C-CODE', 'P-CODE'], errors='ignore'))
+
+
+def compute_alerts(data, drop_threshold=-0.25, min_run=2, workers=None):
+    """Computes every alert of the sheet, one town per worker process.
+
+    Returns a dict with the 'returns', 'dips' and 'drops' tables, ranked the
+    same way as the single-selection engines.
+    """
+    months = month_columns(data.columns)
+    # Factorized codes keep rows without a town as a partition of their own; groupby drops
+    # them from a categorical TOWN even with dropna=False
+    codes, _ = pd.factorize(data['TOWN'], use_na_sentinel=False)
+    partitions = [data.iloc[positions] for positions in pd.Series(codes).groupby(codes).indices.values()]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(town_alerts, partitions, repeat(months), repeat(drop_threshold),
+                                    repeat(min_run)))
+
+    returns, dips, drops = (pd.concat(tables, ignore_index=index) for tables, index in
+                            zip(zip(*results), [True, True, False]))
+    return {
+        'returns': returns.sort_values(['Returns', 'Pharmacy', 'Product'], ascending=[False, True, True],
+                                       kind='stable'),
+        'dips': dips.sort_values(['Sales Dip', 'Pharmacy', 'Product'], ascending=[False, True, True],
+                                 kind='stable'),
+        'drops': drops.sort_index().sort_values('Longest Run', ascending=False, kind='stable'),
+    }
+
+
+def alert_store_path(name, directory=DATASET_DIR):
+    return os.path.join(dataset_path(name, directory), ALERTS_FILE)
+
+
+def write_alert_store(path, alerts, meta):
+    """Writes the alert tables, their lookup indexes and the run metadata to a SQLite file."""
+    # Build into a temporary file first so the dashboard never reads a half-written store
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    with closing(sqlite3.connect(path + '.tmp')) as connection:
+        for table, frame in alerts.items():
+            frame.astype({column: str for column in ALERT_KEYS[table].values()}).to_sql(
+                table, connection, index=False)
+            for column in list(ALERT_KEYS[table].values()) + (['Month'] if 'Month' in frame.columns else []):
+                connection.execute(f'CREATE INDEX "{table}_{column}" ON "{table}" ("{column}")')
+        pd.DataFrame({'key': list(meta), 'value': [str(value) for value in meta.values()]}).to_sql(
+            'meta', connection, index=False)
+        connection.commit()
+    os.replace(path + '.tmp', path)
+
+
+def read_alert_meta(path):
+    """Returns the run metadata of an alert store, or None if there is no store."""
+    if not os.path.isfile(path):
+        return None
+    with closing(sqlite3.connect(path)) as connection:
+        return dict(connection.execute('SELECT key, value FROM meta').fetchall())
+
+
+def read_alerts(path, table, **criteria):
+    """Reads the ranked alerts of one table, filtered by TOWN, NAME, DISCRIPTION or Month.
+
+    A list value matches any of its entries.
+    """
+    clauses, params = [], []
+    for column, value in criteria.items():
+        values = value if isinstance(value, list) else [value]
+        clauses.append(f'"{ALERT_KEYS[table].get(column, column)}" IN ({", ".join("?" * len(values))})')
+        params.extend(str(v) for v in values)
+
+    query = f'SELECT * FROM "{table}"'
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    with closing(sqlite3.connect(path)) as connection:
+        return pd.read_sql_query(query + ' ORDER BY rowid', connection, params=params)
+
+
+def check_running_stats(name, directory=DATASET_DIR):
+    """Compares the stored running statistics of a dataset with a full recompute.
+
+    Returns a list of mismatch descriptions, empty when everything matches.
+    """
+    stats = read_running_stats(name, directory)
+    if stats is None:
+        return [f"Dataset '{name}' has no running statistics"]
+    data = read_dataset(name, directory=directory)
+    expected = build_running_stats(data)
+
+    problems = []
+    if len(stats) != len(expected):
+        return [f'{len(stats)} rows of running statistics for {len(expected)} rows of sales']
+    for column in expected.columns:
+        if column not in stats.columns:
+            problems.append(f"Column '{column}' is missing")
+        elif column in ('Sum', 'Count') or column.startswith('Recent '):
+            mismatched = ~np.isclose(stats[column].to_numpy(dtype='float64'), expected[column].to_numpy(dtype='float64'))
+            if mismatched.any():
+                problems.append(f"'{column}' differs in {mismatched.sum()} rows")
+        else:
+            # Missing identifiers come back as None from storage and NaN from the recompute
+            stored, recomputed = (values.astype(str).where(values.notna(), '').to_numpy()
+                                  for values in (stats[column], expected[column]))
+            if not (stored == recomputed).all():
+                problems.append(f"'{column}' differs")
+
+    month = month_columns(data.columns)[-1]
+    incremental = dips_from_running_stats(stats, month)
+    full = find_sales_dips(data, reference_months=[month])
+    if not incremental[['Pharmacy', 'Product', 'Sales Dip']].astype(str).equals(
+            full[['Pharmacy', 'Product', 'Sales Dip']].astype(str)):
+        problems.append(f'The {month} dips differ from a full recompute')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precompute the sales alerts of a published dataset.')
+    parser.add_argument('dataset', help='name of the published dataset')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--drop-percent', type=float, default=25, help='month-over-month drop that counts, in %%')
+    parser.add_argument('--min-run', type=int, default=2, help='consecutive drops needed for an alert')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the running statistics with a full recompute instead')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        problems = check_running_stats(args.dataset)
+        for problem in problems:
+            print(problem)
+        print('Running statistics match a full recompute' if not problems else 'Running statistics are out of date')
+        raise SystemExit(1 if problems else 0)
+
+    started = time.time()
+    version = dataset_version(args.dataset)
+    data = read_dataset(args.dataset)
+    alerts = compute_alerts(data, -args.drop_percent / 100, args.min_run, args.workers)
+
+    path = alert_store_path(args.dataset)
+    write_alert_store(path, alerts, {'version': version, 'drop_percent': args.drop_percent,
+                                     'min_run': args.min_run, 'computed': time.strftime('%Y-%m-%d %H:%M:%S')})
+    counts = ', '.join(f'{len(frame)} {table}' for table, frame in alerts.items())
+    print(f'Wrote {counts} to {path} in {time.time() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Loading and storage helpers for the wide pharmacy x product sales sheet."""
+
+import json
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Identifier columns of the wide sales sheet; every other column is a month
+ID_COLUMNS = ['C-CODE', 'NAME', 'TOWN', 'P-CODE', 'DISCRIPTION']
+
+# Month column headers look like 'Nov-22'
+MONTH_FORMAT = '%b-%y'
+
+# Directory holding published datasets, one sub-directory per dataset name
+DATASET_DIR = os.environ.get('VARICHEM_DATASET_DIR', 'datasets')
+
+SALES_FILE = 'sales.parquet'
+MANIFEST_FILE = 'manifest.json'
+ROLLUP_DIR = 'rollups'
+STATS_FILE = 'running_stats.parquet'
+
+# Number of most recent months kept in the running statistics, newest first
+RUNNING_WINDOW = 3
+
+# Columns that identify a pharmacy x product row when a new month is appended
+APPEND_KEYS = ['C-CODE', 'P-CODE']
+
+
+def month_columns(columns):
+    """Returns the month columns of the sales sheet in their original order."""
+    return [column for column in columns if column not in ID_COLUMNS]
+
+
+def month_dates(months):
+    """Converts month column headers to Timestamps at the start of each month."""
+    return pd.to_datetime(pd.Index(months), format=MONTH_FORMAT)
+
+
+def compact_month_column(values):
+    """Converts a month column to the smallest numeric dtype that holds it exactly."""
+    values = pd.to_numeric(values, errors='coerce')
+    if values.dtype.kind == 'f' and values.notna().all() and (values % 1 == 0).all():
+        values = values.astype('int64')
+    if values.dtype.kind in 'iu':
+        # Returns are negative quantities, so always keep a signed type
+        return pd.to_numeric(values.astype('int64'), downcast='integer')
+    narrow = values.astype('float32')
+    if np.array_equal(narrow.to_numpy(dtype='float64'), values.to_numpy(dtype='float64'), equal_nan=True):
+        return narrow
+    return values
+
+
+def compact_sales_frame(data):
+    """Returns the sales sheet with categorical identifiers and downcast month columns."""
+    data = data.copy()
+    for column in ID_COLUMNS:
+        if column not in data.columns:
+            continue
+        if data[column].dtype.name != 'category':
+            data[column] = data[column].astype('category')
+        # Ordered categories keep groupby(..., observed=True) results sorted by name
+        if not data[column].cat.ordered:
+            data[column] = data[column].cat.as_ordered()
+    for month in month_columns(data.columns):
+        data[month] = compact_month_column(data[month])
+    return data
+
+
+def memory_footprint(data):
+    """Returns the deep memory usage of a DataFrame in bytes."""
+    return int(data.memory_usage(deep=True).sum())
+
+
+def build_sales_facts(data):
+    """Builds the long fact table of the sales sheet, indexed and sorted by month.
+
+    There is one row per non-zero pharmacy x product x month cell, holding the
+    identifier columns, the month as a Timestamp index and the ``Units`` sold.
+    Zero cells are left out, so selecting a month is a slice of its own rows
+    rather than a melt of the whole sheet.
+    """
+    months = month_columns(data.columns)
+    id_columns = [column for column in ID_COLUMNS if column in data.columns]
+    values = data[months].to_numpy(dtype='float64')
+
+    # Walking the transposed mask yields cells ordered by month, then by row
+    month_index, row_index = np.nonzero(((values != 0) & ~np.isnan(values)).T)
+    facts = data[id_columns].take(row_index).reset_index(drop=True)
+    facts['Units'] = compact_month_column(pd.Series(values[row_index, month_index]))
+    facts.index = pd.DatetimeIndex(month_dates(months).take(month_index), name='Month')
+    return facts
+
+
+def month_facts(facts, month):
+    """Returns the fact rows of one month ('Nov-22' or a Timestamp) as a slice."""
+    month = pd.Timestamp(month_dates([month])[0]) if isinstance(month, str) else pd.Timestamp(month)
+    return facts.loc[month:month]
+
+
+# Columns with an inverted row index, and the column pairs indexed together
+INDEX_COLUMNS = ['TOWN', 'NAME', 'DISCRIPTION']
+INDEX_PAIRS = [('TOWN', 'DISCRIPTION')]
+
+
+def build_row_index(data):
+    """Maps every town, pharmacy, product and town x product pair to its row positions.
+
+    Keys are the string form of the values, as shown in the filter widgets.
+    """
+    row_index = {}
+    for column in INDEX_COLUMNS:
+        if column in data.columns:
+            groups = data.groupby(column, observed=True).indices
+            row_index[column] = {str(key): positions for key, positions in groups.items()}
+    for pair in INDEX_PAIRS:
+        if all(column in data.columns for column in pair):
+            groups = data.groupby(list(pair), observed=True).indices
+            row_index[pair] = {tuple(map(str, key)): positions for key, positions in groups.items()}
+    return row_index
+
+
+def row_positions(row_index, within=None, **criteria):
+    """Returns the sorted row positions matching every criterion, e.g. TOWN='Harare'.
+
+    A criterion is a single value or a list of values for an indexed column.
+    ``within`` limits the result to previously selected positions. The work
+    done depends on the size of the result, not on the size of the sheet.
+    """
+    empty = np.array([], dtype=np.intp)
+    selections = []
+    for pair in INDEX_PAIRS:
+        if pair in row_index and all(isinstance(criteria.get(column), str) for column in pair):
+            key = tuple(criteria.pop(column) for column in pair)
+            selections.append(row_index[pair].get(key, empty))
+    for column, values in criteria.items():
+        values = [values] if isinstance(values, str) else values
+        selections.append(np.concatenate([row_index[column].get(str(value), empty) for value in values] or [empty]))
+    if within is not None:
+        selections.append(within)
+
+    if not selections:
+        raise ValueError('row_positions needs at least one criterion or a within selection')
+    positions = np.sort(selections[0])
+    for selection in selections[1:]:
+        positions = np.intersect1d(positions, selection)
+    return positions
+
+
+# Monthly aggregation levels of the sales sheet and the columns each one groups by.
+# Together they form the rollup cube that the analysis pages query.
+ROLLUP_LEVELS = {
+    'product': ['DISCRIPTION'],
+    'town': ['TOWN'],
+    'pharmacy': ['NAME'],
+    'town_product': ['TOWN', 'DISCRIPTION'],
+    'pharmacy_product': ['NAME', 'DISCRIPTION'],
+}
+
+# The pharmacy x product level is about as large as the sheet itself, so
+# streaming mode leaves it out
+STREAM_ROLLUP_LEVELS = {level: keys for level, keys in ROLLUP_LEVELS.items() if level != 'pharmacy_product'}
+
+
+def build_rollups(data, levels=ROLLUP_LEVELS):
+    """Sums the month columns per aggregation level.
+
+    Levels whose grouping columns are not loaded are skipped. The ``'total'``
+    entry holds the month totals over every row.
+    """
+    months = month_columns(data.columns)
+    rollups = {'total': data[months].sum()}
+    for level, keys in levels.items():
+        if all(key in data.columns for key in keys):
+            rollups[level] = data.groupby(keys, observed=True)[months].sum()
+    return rollups
+
+
+def stream_rollups(source, chunksize=200_000, levels=STREAM_ROLLUP_LEVELS):
+    """Builds the same rollups as build_rollups from a sales CSV read chunk by chunk.
+
+    Only the running aggregates are kept between chunks, so memory use depends
+    on the number of towns, products and pharmacies rather than on the row count.
+    """
+    rollups = None
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        months = month_columns(chunk.columns)
+        chunk[months] = chunk[months].apply(pd.to_numeric, errors='coerce')
+        partial = build_rollups(chunk, levels)
+        if rollups is None:
+            rollups = partial
+            continue
+        rollups['total'] = rollups['total'].add(partial['total'], fill_value=0)
+        for level, keys in levels.items():
+            if level in partial:
+                merged = pd.concat([rollups[level], partial[level]])
+                rollups[level] = merged.groupby(level=list(range(len(keys)))).sum()
+    if rollups is None:
+        raise ValueError('The sales file is empty')
+    return rollups
+
+
+def build_running_stats(data, window=RUNNING_WINDOW):
+    """Computes the running statistics of every row of the sales sheet.
+
+    Returns the identifier columns with the Sum and Count of all months and the
+    sales of the ``window`` most recent months ('Recent 1' is the newest),
+    aligned row for row with ``data``.
+    """
+    months = month_columns(data.columns)
+    values = data[months].to_numpy()
+    values = values.astype('int64') if values.dtype.kind in 'iu' else values.astype('float64')
+
+    stats = data[[column for column in ID_COLUMNS if column in data.columns]].reset_index(drop=True)
+    stats['Sum'] = values.sum(axis=1)
+    stats['Count'] = len(months)
+    for lag in range(window):
+        stats[f'Recent {lag + 1}'] = values[:, -1 - lag] if lag < len(months) else 0
+    return stats
+
+
+def advance_running_stats(stats, updated, month):
+    """Adds one new month to running statistics without touching the earlier months.
+
+    ``updated`` is the sales sheet after the append; its first ``len(stats)``
+    rows must be the rows the statistics were computed from. Rows added by the
+    append had zero sales in every earlier month.
+    """
+    new_values = updated[month].to_numpy()
+    new_values = new_values.astype('int64') if new_values.dtype.kind in 'iu' else new_values.astype('float64')
+    recent = sorted((column for column in stats.columns if column.startswith('Recent ')),
+                    key=lambda column: int(column.split()[1]))
+
+    added = updated.iloc[len(stats):][[column for column in ID_COLUMNS if column in stats.columns]]
+    added = added.assign(Sum=0, Count=stats['Count'].iloc[0] if len(stats) else 0, **{column: 0 for column in recent})
+    advanced = pd.concat([stats, added], ignore_index=True)
+
+    advanced['Sum'] = advanced['Sum'].to_numpy() + new_values
+    advanced['Count'] += 1
+    for newer, older in zip(recent[-2::-1], recent[:0:-1]):
+        advanced[older] = advanced[newer]
+    advanced[recent[0]] = new_values
+    return advanced
+
+
+def dataset_path(name, directory=DATASET_DIR):
+    if not re.fullmatch(r'[\w\- ]+', name or ''):
+        raise ValueError(f"Invalid dataset name '{name}': use letters, digits, spaces, '-' or '_'")
+    return os.path.join(directory, name)
+
+
+def list_datasets(directory=DATASET_DIR):
+    """Returns the names of the published datasets, sorted."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, name, MANIFEST_FILE)))
+
+
+def read_manifest(name, directory=DATASET_DIR):
+    with open(os.path.join(dataset_path(name, directory), MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def write_manifest(name, manifest, directory=DATASET_DIR):
+    path = os.path.join(dataset_path(name, directory), MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def dataset_version(name, directory=DATASET_DIR):
+    """Returns a token that changes whenever the stored dataset is rewritten."""
+    return os.stat(os.path.join(dataset_path(name, directory), MANIFEST_FILE)).st_mtime_ns
+
+
+def _write_parquet(frame, path):
+    # Write to a temporary file first so readers never see a half-written file
+    frame.to_parquet(path + '.tmp', engine='pyarrow', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def _plain_rollup(rollup):
+    # Stored rollups use plain object keys so that later appends can add new keys
+    rollup = rollup.reset_index()
+    keys = [column for column in rollup.columns if column in ID_COLUMNS]
+    rollup[keys] = rollup[keys].astype(object)
+    return rollup.set_index(keys)
+
+
+def write_rollups(name, rollups, directory=DATASET_DIR):
+    path = os.path.join(dataset_path(name, directory), ROLLUP_DIR)
+    os.makedirs(path, exist_ok=True)
+    _write_parquet(rollups['total'].to_frame('total').T, os.path.join(path, 'total.parquet'))
+    for level in ROLLUP_LEVELS:
+        if level in rollups:
+            _write_parquet(_plain_rollup(rollups[level]).reset_index(), os.path.join(path, f'{level}.parquet'))
+
+
+def write_running_stats(name, stats, directory=DATASET_DIR):
+    plain = stats.astype({column: object for column in ID_COLUMNS if column in stats.columns})
+    _write_parquet(plain, os.path.join(dataset_path(name, directory), STATS_FILE))
+
+
+def read_running_stats(name, directory=DATASET_DIR):
+    """Returns the running statistics of a published dataset, or None for datasets published without them."""
+    path = os.path.join(dataset_path(name, directory), STATS_FILE)
+    if not os.path.isfile(path):
+        return None
+    return pd.read_parquet(path, engine='pyarrow')
+
+
+def read_rollups(name, directory=DATASET_DIR):
+    """Returns the stored rollups of a published dataset, or None for datasets published without them."""
+    path = os.path.join(dataset_path(name, directory), ROLLUP_DIR)
+    if not os.path.isdir(path):
+        return None
+    rollups = {'total': pd.read_parquet(os.path.join(path, 'total.parquet'), engine='pyarrow').iloc[0]}
+    for level, keys in ROLLUP_LEVELS.items():
+        level_file = os.path.join(path, f'{level}.parquet')
+        if os.path.isfile(level_file):
+            rollups[level] = pd.read_parquet(level_file, engine='pyarrow').set_index(keys)
+    return rollups
+
+
+def publish_dataset(data, name, directory=DATASET_DIR):
+    """Writes the wide sales sheet and its monthly rollups to Parquet files and returns the manifest."""
+    missing = [column for column in ID_COLUMNS if column not in data.columns]
+    if missing:
+        raise ValueError(f"The sales sheet is missing the columns: {', '.join(missing)}")
+
+    path = dataset_path(name, directory)
+    os.makedirs(path, exist_ok=True)
+
+    data = compact_sales_frame(data)
+    _write_parquet(data, os.path.join(path, SALES_FILE))
+    write_rollups(name, build_rollups(data), directory)
+    write_running_stats(name, build_running_stats(data), directory)
+
+    manifest = {
+        'name': name,
+        'months': month_columns(data.columns),
+        'rows': len(data),
+        'published': datetime.now().isoformat(timespec='seconds'),
+    }
+    write_manifest(name, manifest, directory)
+    return manifest
+
+
+def read_dataset(name, id_columns=None, include_months=True, directory=DATASET_DIR):
+    """Reads a published dataset in its compact typed form, loading only the requested identifier columns.
+
+    ``id_columns=None`` loads every identifier column; the month columns are
+    always loaded unless ``include_months`` is False.
+    """
+    columns = list(ID_COLUMNS if id_columns is None else id_columns)
+    if include_months:
+        columns += read_manifest(name, directory)['months']
+    data = pd.read_parquet(os.path.join(dataset_path(name, directory), SALES_FILE),
+                           engine='pyarrow', columns=columns)
+    return compact_sales_frame(data)
+
+
+def append_month(name, new_data, directory=DATASET_DIR):
+    """Merges one new month column, keyed by C-CODE and P-CODE, into a published dataset.
+
+    Rows of the dataset missing from ``new_data`` get zero for the new month.
+    Keys not yet in the dataset are added as new rows when ``new_data`` carries
+    every identifier column and are skipped otherwise. Only the new month is
+    aggregated into the stored rollups and running statistics. Returns the updated manifest, whose
+    ``last_append`` entry summarises the rows matched, added and skipped. A precomputed alert
+    store goes out of date and needs a new batch run (python sales_alerts.py <dataset>).
+    """
+    manifest = read_manifest(name, directory)
+    missing = [key for key in APPEND_KEYS if key not in new_data.columns]
+    if missing:
+        raise ValueError(f"The append file is missing the columns: {', '.join(missing)}")
+    new_months = month_columns(new_data.columns)
+    if len(new_months) != 1:
+        raise ValueError('The append file must hold exactly one month column besides the identifier columns')
+    month = new_months[0]
+    if month in manifest['months']:
+        raise ValueError(f"Month '{month}' is already in dataset '{name}'")
+    try:
+        month_date = month_dates([month])[0]
+    except ValueError:
+        raise ValueError(f"Month column '{month}' does not match the format of the other months, e.g. "
+                         f"'{pd.Timestamp.today():{MONTH_FORMAT}}'") from None
+    if manifest['months'] and month_date <= month_dates(manifest['months'][-1:])[0]:
+        raise ValueError(f"Month '{month}' is not later than the last month '{manifest['months'][-1]}' "
+                         f"of dataset '{name}'")
+
+    path = dataset_path(name, directory)
+    stored = pd.read_parquet(os.path.join(path, SALES_FILE), engine='pyarrow')
+    stored[ID_COLUMNS] = stored[ID_COLUMNS].astype(object)
+
+    # One value per key; codes are matched on their string form
+    new_data = new_data.copy()
+    new_data[APPEND_KEYS] = new_data[APPEND_KEYS].astype(str)
+    new_data[month] = pd.to_numeric(new_data[month], errors='coerce').fillna(0)
+    new_values = new_data.groupby(APPEND_KEYS)[month].sum()
+
+    # Position of the first stored row for each key
+    stored_keys = pd.MultiIndex.from_arrays([stored[key].astype(str) for key in APPEND_KEYS])
+    first = ~stored_keys.duplicated()
+    positions = pd.Series(np.flatnonzero(first), index=stored_keys[first]).reindex(new_values.index)
+    matched = positions.notna().to_numpy()
+
+    column = np.zeros(len(stored), dtype=new_values.dtype)
+    column[positions[matched].astype(int).to_numpy()] = new_values[matched].to_numpy()
+    stored[month] = column
+
+    # Keys not seen before become new rows when the file says which pharmacy and product they are
+    unmatched = new_values.index[~matched]
+    added = pd.DataFrame(columns=stored.columns)
+    if len(unmatched) and all(column in new_data.columns for column in ID_COLUMNS):
+        added = (new_data.drop_duplicates(APPEND_KEYS).set_index(APPEND_KEYS).loc[unmatched]
+                 .reset_index()[ID_COLUMNS])
+        added[month] = new_values[unmatched].to_numpy()
+        added = added.reindex(columns=stored.columns, fill_value=0)
+    updated = compact_sales_frame(pd.concat([stored, added], ignore_index=True))
+    _write_parquet(updated, os.path.join(path, SALES_FILE))
+
+    # Aggregate only the new month and add it next to the existing rollup columns
+    rollups = read_rollups(name, directory)
+    if rollups is None:
+        rollups = build_rollups(updated)
+    else:
+        partial = build_rollups(updated[ID_COLUMNS + [month]])
+        rollups['total'][month] = partial['total'][month]
+        for level in ROLLUP_LEVELS:
+            if level not in rollups:
+                rollups[level] = _plain_rollup(build_rollups(updated, {level: ROLLUP_LEVELS[level]})[level])
+                continue
+            current, increment = rollups[level], _plain_rollup(partial[level])
+            current = current.reindex(current.index.union(increment.index), fill_value=0)
+            current[month] = increment[month].reindex(current.index, fill_value=0)
+            rollups[level] = current
+    write_rollups(name, rollups, directory)
+
+    # Running statistics only take in the new month; datasets published without them get a full build
+    stats = read_running_stats(name, directory)
+    if stats is None or len(stats) != len(stored):
+        stats = build_running_stats(updated)
+    else:
+        stats = advance_running_stats(stats, updated, month)
+    write_running_stats(name, stats, directory)
+
+    manifest['months'].append(month)
+    manifest['rows'] = len(updated)
+    manifest['last_append'] = {
+        'month': month,
+        'appended': datetime.now().isoformat(timespec='seconds'),
+        'matched_rows': int(matched.sum()),
+        'added_rows': len(added),
+        'skipped_keys': int(len(unmatched) - len(added)),
+    }
+    write_manifest(name, manifest, directory)
+    return manifest
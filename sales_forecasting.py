@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Fitting and caching of the monthly product sales forecasts."""
+
+import glob
+import hashlib
+import os
+import re
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
+import numpy as np
+import pandas as pd
+from pmdarima import ARIMA, auto_arima
+from pmdarima.arima import AutoARIMA
+from pmdarima.pipeline import Pipeline
+from pmdarima.preprocessing import FourierFeaturizer
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, cg
+
+from sales_data import month_dates
+
+# Directory holding fitted forecast models, shared by every session and kept across restarts
+MODEL_DIR = os.environ.get('VARICHEM_MODEL_DIR', 'models')
+
+# Cached models kept per product and model kind; enough for the current series and the
+# backtest origins, while fingerprints superseded by appended months are deleted
+MODELS_KEPT = 8
+
+# Length of the yearly cycle captured by the seasonal model, in months
+SEASONAL_PERIOD = 12
+
+
+def series_fingerprint(series):
+    """Returns a short hash of a monthly series' dates and values; any change to the data changes it."""
+    digest = hashlib.sha256()
+    digest.update('|'.join(map(str, series.index)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(series.to_numpy(dtype='float64')).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def model_path(product, fingerprint, kind='arima', directory=MODEL_DIR):
+    # Readable product prefix plus a hash of the full name, so different names never share a file
+    slug = re.sub(r'[^\w\-]+', '_', str(product)).strip('_')[:40]
+    name_hash = hashlib.sha256(str(product).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(directory, f'{slug}-{name_hash}-{kind}-{fingerprint}.pkl')
+
+
+def fit_arima(series):
+    """Fits a non-seasonal auto ARIMA model to a monthly series."""
+    return auto_arima(series.astype('float64'), seasonal=False, suppress_warnings=True, error_action='ignore')
+
+
+def fit_seasonal(series):
+    """Fits a non-seasonal auto ARIMA model with Fourier terms of a yearly cycle as regressors.
+
+    A cheap stand-in for a seasonal order search, which is too slow to run
+    interactively; series shorter than two cycles get a single harmonic.
+    """
+    harmonics = 2 if len(series) >= 2 * SEASONAL_PERIOD else 1
+    return Pipeline([
+        ('fourier', FourierFeaturizer(m=SEASONAL_PERIOD, k=harmonics)),
+        ('arima', AutoARIMA(seasonal=False, suppress_warnings=True, error_action='ignore')),
+    ]).fit(series.to_numpy(dtype='float64'))
+
+
+# Forecast model kinds fitted one series at a time: display name and fitting function
+FORECAST_MODELS = {
+    'arima': ('auto ARIMA', fit_arima),
+    'seasonal': ('Seasonal auto ARIMA (Fourier)', fit_seasonal),
+}
+
+
+def model_order(model):
+    """Returns the (p, d, q) order of a fitted model or of the ARIMA step of a seasonal pipeline."""
+    return model.steps[-1][1].model_.order if isinstance(model, Pipeline) else model.order
+
+
+def fit_fallback(series):
+    """Fits a fixed ARIMA(0,1,1) model, a cheap stand-in when the auto ARIMA search takes too long."""
+    return ARIMA(order=(0, 1, 1), suppress_warnings=True).fit(series.astype('float64'))
+
+
+def load_model(product, fingerprint, kind='arima', directory=MODEL_DIR):
+    """Returns a cached fitted model, or None when there is no readable cache entry."""
+    path = model_path(product, fingerprint, kind, directory)
+    if os.path.isfile(path):
+        try:
+            model = joblib.load(path)
+            os.utime(path)  # Marks the entry as recently used for prune_models
+            return model
+        except Exception:
+            pass  # An unreadable cache entry is simply refitted and overwritten
+    return None
+
+
+def _used_time(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0  # Deleted meanwhile by another worker
+
+
+def prune_models(product, kind='arima', directory=MODEL_DIR, keep=MODELS_KEPT):
+    """Deletes all but the ``keep`` most recently used cached models of a product and model kind."""
+    prefix = model_path(product, '', kind, directory)[:-len('.pkl')]
+    paths = sorted(glob.glob(glob.escape(prefix) + '?' * 16 + '.pkl'), key=_used_time, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Already deleted by another worker
+
+
+def store_model(model, product, fingerprint, kind='arima', directory=MODEL_DIR):
+    path = model_path(product, fingerprint, kind, directory)
+    os.makedirs(directory, exist_ok=True)
+    joblib.dump(model, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    prune_models(product, kind, directory)
+    return model
+
+
+def cached_model(product, series, kind='arima', directory=MODEL_DIR):
+    """Returns the fitted model of a product's series, loading it from the model cache when present.
+
+    Models are keyed by product, model kind (see FORECAST_MODELS) and the
+    fingerprint of the series, so a changed series (e.g. after a new month is
+    appended) is refitted.
+    """
+    fingerprint = series_fingerprint(series)
+    model = load_model(product, fingerprint, kind, directory)
+    if model is None:
+        model = store_model(FORECAST_MODELS[kind][1](series), product, fingerprint, kind, directory)
+    return model
+
+
+class FitTimeout(Exception):
+    """Raised when a model fit runs past its time limit."""
+
+
+def _raise_timeout(signum, frame):
+    raise FitTimeout()
+
+
+def fit_with_timeout(fit, series, timeout):
+    """Runs ``fit(series)``, raising FitTimeout after ``timeout`` seconds.
+
+    The limit relies on SIGALRM, so it only applies in the main thread of a
+    process on platforms that have it (worker processes qualify); elsewhere the
+    fit simply runs to completion.
+    """
+    if not timeout or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        return fit(series)
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fit(series)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def forecast_errors(actual, predicted):
+    """Returns the MAE, RMSE and MAPE (in %) of predictions along the last axis.
+
+    MAPE only counts months with non-zero actual sales and is NaN when there are none.
+    """
+    errors = actual - predicted
+    nonzero = actual != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage = np.abs(errors / np.where(nonzero, actual, 1)) * nonzero
+        mape = percentage.sum(axis=-1) / nonzero.sum(axis=-1) * 100
+    return np.mean(np.abs(errors), axis=-1), np.sqrt(np.mean(errors ** 2, axis=-1)), mape
+
+
+def forecast_product(product, series, horizon, timeout=None, directory=MODEL_DIR, kind='arima'):
+    """Fits (or loads) the forecast model of one product and forecasts ``horizon`` months ahead.
+
+    Returns one record with the Product, the Model used, its in-sample MAE,
+    RMSE and MAPE and the forecast for each future month. Fits that exceed
+    ``timeout`` seconds fall back to ARIMA(0,1,1).
+    """
+    fingerprint = series_fingerprint(series)
+    record = {'Product': product}
+    try:
+        name, fit = FORECAST_MODELS[kind]
+        model, record['Model'] = load_model(product, fingerprint, kind, directory), name
+        if model is None:
+            try:
+                model = store_model(fit_with_timeout(fit, series, timeout), product, fingerprint, kind, directory)
+            except FitTimeout:
+                record['Model'] = 'ARIMA(0,1,1) fallback'
+                model = load_model(product, fingerprint, 'fallback', directory)
+                if model is None:
+                    model = store_model(fit_fallback(series), product, fingerprint, 'fallback', directory)
+        order = model_order(model)
+        record['Order'] = str(order)
+
+        # In-sample one-step errors, skipping the months consumed by differencing
+        actual = series.to_numpy(dtype='float64')[order[1]:]
+        fitted = np.asarray(model.predict_in_sample(), dtype='float64')[order[1]:]
+        record.update(zip(['MAE', 'RMSE', 'MAPE'], forecast_errors(actual, fitted)))
+
+        forecast = np.asarray(model.predict(n_periods=horizon), dtype='float64')
+        record.update(zip(_future_months(series.index[-1], horizon), np.round(forecast).astype(int)))
+    except Exception as e:
+        record['Error'] = str(e)
+    return record
+
+
+def forecast_catalogue(product_rollup, horizon, timeout=None, workers=None, progress=None,
+                       directory=MODEL_DIR, kind='arima'):
+    """Forecasts every product of the product rollup in a pool of worker processes.
+
+    ``workers`` defaults to one per CPU core; ``progress(done, total)`` is
+    called as products finish. Returns one row per product, sorted by product.
+    """
+    products = sorted(product_rollup.index)
+    records = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(forecast_product, product, product_series(product_rollup, product), horizon,
+                                   timeout, directory, kind) for product in products]
+        for done, future in enumerate(as_completed(futures), start=1):
+            records.append(future.result())
+            if progress is not None:
+                progress(done, len(products))
+    return pd.DataFrame(records).sort_values('Product', kind='stable').reset_index(drop=True)
+
+
+def product_series(product_rollup, product):
+    """Returns the monthly sales of one product from the product rollup as a date-indexed series."""
+    sales = product_rollup.loc[product]
+    return pd.Series(sales.to_numpy(), index=month_dates(sales.index), name=product).sort_index()
+
+
+# Smoothing parameters searched for every series at once; simple smoothing has no trend
+SMOOTHING_METHODS = {
+    'Simple': {'alpha': np.linspace(0.05, 0.95, 19), 'beta': [0.0], 'phi': [1.0]},
+    'Holt': {'alpha': np.linspace(0.1, 0.9, 9), 'beta': [0.05, 0.1, 0.2, 0.3], 'phi': [1.0]},
+    'Damped trend': {'alpha': np.linspace(0.1, 0.9, 9), 'beta': [0.05, 0.1, 0.2, 0.3], 'phi': [0.8, 0.9, 0.98]},
+}
+
+
+def _smooth(y, alpha, beta, phi, trend, keep_fitted=False):
+    # Additive (damped) trend recursion, one time step at a time but vectorised over series and
+    # parameter sets; the parameters broadcast against the series axis
+    n_months = y.shape[-1]
+    shape = np.broadcast_shapes(np.shape(alpha), y.shape[:-1])
+    level = np.broadcast_to(y[..., 0], shape).copy()
+    slope = np.broadcast_to(y[..., 1] - y[..., 0] if trend and n_months > 1 else 0.0, shape).copy()
+    sse = np.zeros(shape)
+    fitted = np.empty(shape + (n_months,)) if keep_fitted else None
+    if keep_fitted:
+        fitted[..., 0] = y[..., 0]
+
+    for t in range(1, n_months):
+        prediction = level + phi * slope
+        sse += (y[..., t] - prediction) ** 2
+        if keep_fitted:
+            fitted[..., t] = prediction
+        new_level = alpha * y[..., t] + (1 - alpha) * prediction
+        slope = beta * (new_level - level) + (1 - beta) * phi * slope
+        level = new_level
+    return level, slope, sse, fitted
+
+
+def smoothing_forecast(values, horizon, method='Damped trend'):
+    """Fits simple, Holt or damped-trend exponential smoothing to every row of a series matrix at once.
+
+    ``values`` holds one series per row, months in columns. Each row gets the
+    grid parameters with the lowest one-step squared error. Returns a dict with
+    the ``forecast`` (rows x horizon), the chosen ``alpha``, ``beta`` and
+    ``phi`` per row, the ``fitted`` one-step predictions and the final
+    ``level`` and ``slope`` of every row.
+    """
+    y = np.atleast_2d(np.asarray(values, dtype='float64'))
+    grid = SMOOTHING_METHODS[method]
+    trend = method != 'Simple'
+    alpha, beta, phi = (np.asarray(p, dtype='float64').ravel()[:, None] for p in
+                        np.meshgrid(grid['alpha'], grid['beta'], grid['phi'], indexing='ij'))
+
+    # Grid search: every parameter set against every series, then the best set per series
+    _, _, sse, _ = _smooth(y[None, :, :], alpha, beta, phi, trend)
+    best = sse.argmin(axis=0)
+    alpha, beta, phi = alpha[best, 0], beta[best, 0], phi[best, 0]
+
+    level, slope, _, fitted = _smooth(y, alpha, beta, phi, trend, keep_fitted=True)
+    damping = np.cumsum(phi[:, None] ** np.arange(1, horizon + 1), axis=1)
+    return {
+        'forecast': level[:, None] + damping * slope[:, None],
+        'alpha': alpha,
+        'beta': beta,
+        'phi': phi,
+        'fitted': fitted,
+        'level': level,
+        'slope': slope,
+    }
+
+
+def smoothing_catalogue(rollup, horizon, method='Damped trend'):
+    """Forecasts every row of a monthly rollup (products, or pharmacy x product pairs) in one vectorized fit.
+
+    Returns one row per series with the Model, its parameters, in-sample MAE,
+    RMSE and MAPE and the rounded forecast for each future month, in the same
+    layout as ``forecast_catalogue``.
+    """
+    values, last_month = _rollup_history(rollup)
+    result = smoothing_forecast(values, horizon, method)
+
+    table = _rollup_labels(rollup)
+    table['Model'] = f'{method} smoothing'
+    table['Alpha'], table['Beta'], table['Phi'] = result['alpha'], result['beta'], result['phi']
+    table['MAE'], table['RMSE'], table['MAPE'] = forecast_errors(values[:, 1:], result['fitted'][:, 1:])
+
+    forecasts = pd.DataFrame(np.round(result['forecast']).astype(int), columns=_future_months(last_month, horizon))
+    return pd.concat([table, forecasts], axis=1)
+
+
+def _rollup_history(rollup):
+    # Rollup values with the months in date order, and the last month
+    dates = month_dates(rollup.columns)
+    order = np.argsort(dates, kind='stable')
+    return rollup.to_numpy(dtype='float64')[:, order], dates[order[-1]]
+
+
+def _rollup_labels(rollup):
+    return rollup.index.to_frame(index=False).rename(columns={'NAME': 'Pharmacy', 'TOWN': 'Town',
+                                                              'DISCRIPTION': 'Product'})
+
+
+def _future_months(last_month, horizon):
+    return pd.date_range(last_month, periods=horizon + 1, freq='MS')[1:].strftime('%b-%y')
+
+
+# Engines compared by the backtest; 'Naive' repeats the last observed month as a baseline
+ARIMA_ENGINES = {'Auto ARIMA': 'arima', 'Seasonal ARIMA': 'seasonal'}
+BACKTEST_ENGINES = list(ARIMA_ENGINES) + [f'{method} smoothing' for method in SMOOTHING_METHODS] + ['Naive']
+
+# Fewest months a training window may have in the backtest
+MIN_TRAIN_MONTHS = 6
+
+
+def backtest_origin(product, train, test, engines=BACKTEST_ENGINES, directory=MODEL_DIR):
+    """Fits each engine on one training window and forecasts the months that follow it.
+
+    Returns one record per engine and horizon with the actual and forecast sales.
+    ARIMA fits go through the model cache, so repeated backtests reuse them; an
+    ARIMA engine that cannot fit a training window is left out for that origin.
+    """
+    records = []
+    for engine in engines:
+        if engine in ARIMA_ENGINES:
+            try:
+                forecast = cached_model(product, train, ARIMA_ENGINES[engine], directory).predict(n_periods=len(test))
+            except ValueError:
+                continue
+        elif engine == 'Naive':
+            forecast = np.repeat(float(train.iloc[-1]), len(test))
+        else:
+            forecast = smoothing_forecast(train.to_numpy(), len(test), engine[:-len(' smoothing')])['forecast'][0]
+        for horizon, (actual, predicted) in enumerate(zip(test.to_numpy(dtype='float64'), np.asarray(forecast)), start=1):
+            records.append({'Product': product, 'Engine': engine, 'Origin': train.index[-1].strftime('%b-%y'),
+                            'Horizon': horizon, 'Actual': actual, 'Forecast': float(predicted)})
+    return records
+
+
+def rolling_origin_backtest(series_by_product, horizon, origins=3, engines=BACKTEST_ENGINES, workers=None,
+                            progress=None, directory=MODEL_DIR):
+    """Backtests every engine on each product's last ``origins`` forecast origins, one origin per worker.
+
+    At each origin the engines are refitted on the months before it and
+    forecast the next ``horizon`` months, which were held out. Origins that
+    would leave fewer than MIN_TRAIN_MONTHS months of training are skipped.
+    Returns one record per product, engine, origin and horizon.
+    """
+    tasks = []
+    for product, series in series_by_product.items():
+        for step in range(origins):
+            cut = len(series) - horizon - step
+            if cut < MIN_TRAIN_MONTHS:
+                break
+            tasks.append((product, series.iloc[:cut], series.iloc[cut:cut + horizon]))
+
+    records = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(backtest_origin, product, train, test, engines, directory)
+                   for product, train, test in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            records.extend(future.result())
+            if progress is not None:
+                progress(done, len(tasks))
+    return pd.DataFrame(records, columns=['Product', 'Engine', 'Origin', 'Horizon', 'Actual', 'Forecast'])
+
+
+def backtest_summary(results):
+    """Returns the out-of-sample MAE, RMSE and MAPE of every engine at every horizon."""
+    rows = []
+    for (engine, horizon), group in results.groupby(['Engine', 'Horizon'], sort=True):
+        mae, rmse, mape = forecast_errors(group['Actual'].to_numpy(), group['Forecast'].to_numpy())
+        rows.append({'Engine': engine, 'Horizon': horizon, 'MAE': mae, 'RMSE': rmse, 'MAPE': mape,
+                     'Forecasts': len(group)})
+    return pd.DataFrame(rows, columns=['Engine', 'Horizon', 'MAE', 'RMSE', 'MAPE', 'Forecasts'])
+
+
+# Ways of making the national, town and pharmacy forecasts add up
+RECONCILIATION_METHODS = ['Bottom-up', 'OLS', 'WLS (structural)', 'WLS (variance)']
+
+
+def summing_matrix(towns):
+    """Builds the sparse summing matrix of a national -> town -> pharmacy hierarchy.
+
+    ``towns`` gives the town of every bottom-level (pharmacy) series. Returns
+    the matrix, with one row for the nation, one per town and one per pharmacy
+    (in that order), and the sorted town labels of the town rows.
+    """
+    town_labels, town_of = np.unique(np.asarray(towns, dtype=str), return_inverse=True)
+    n_bottom = len(town_of)
+    national = sparse.csr_matrix(np.ones((1, n_bottom)))
+    by_town = sparse.csr_matrix((np.ones(n_bottom), (town_of, np.arange(n_bottom))), shape=(len(town_labels), n_bottom))
+    return sparse.vstack([national, by_town, sparse.identity(n_bottom, format='csr')], format='csr'), town_labels
+
+
+def reconcile(summing, base, weights=None):
+    """Reconciles base forecasts of every node so that each level adds up, by generalised least squares.
+
+    Solves (S' W^-1 S) b = S' W^-1 y for the bottom-level forecasts b of each
+    horizon with conjugate gradients on a LinearOperator, so only the sparse
+    summing matrix S is ever stored, and returns S b for every node. ``weights``
+    holds the diagonal of W (ordinary least squares when None).
+    """
+    inverse_weights = np.ones(summing.shape[0]) if weights is None else 1 / np.asarray(weights, dtype='float64')
+    n_bottom = summing.shape[1]
+    normal = LinearOperator((n_bottom, n_bottom), matvec=lambda v: summing.T @ (inverse_weights * (summing @ v)),
+                            dtype='float64')
+
+    bottom = np.empty((n_bottom, base.shape[1]))
+    for step in range(base.shape[1]):
+        rhs = summing.T @ (inverse_weights * base[:, step])
+        bottom[:, step], info = cg(normal, rhs, x0=base[-n_bottom:, step], rtol=1e-10, atol=0, maxiter=10 * n_bottom)
+        if info > 0:
+            raise RuntimeError(f'Reconciliation did not converge for horizon {step + 1}')
+    return summing @ bottom
+
+
+def hierarchical_forecast(bottom, horizon, method='Damped trend', reconciliation='WLS (structural)'):
+    """Forecasts a product nationally, per town and per pharmacy so that the levels add up.
+
+    ``bottom`` holds the monthly sales of each pharmacy, indexed by TOWN and
+    NAME, months in columns. Every node of the hierarchy gets a base forecast
+    from one vectorized smoothing fit; the base forecasts are then reconciled.
+    Returns one row per node with its Level, Town, Pharmacy, base and
+    reconciled forecast for each future month.
+    """
+    dates = month_dates(bottom.columns)
+    order = np.argsort(dates, kind='stable')
+    summing, town_labels = summing_matrix(bottom.index.get_level_values('TOWN'))
+    history = summing @ bottom.to_numpy(dtype='float64')[:, order]
+
+    result = smoothing_forecast(history, horizon, method)
+    base = result['forecast']
+    if reconciliation == 'Bottom-up':
+        reconciled = summing @ base[-bottom.shape[0]:]
+    else:
+        weights = None
+        if reconciliation == 'WLS (structural)':
+            # Each node weighted by the number of pharmacies under it
+            weights = np.asarray(summing.sum(axis=1)).ravel()
+        elif reconciliation == 'WLS (variance)':
+            # Each node weighted by its in-sample one-step error variance, floored to keep W invertible
+            variance = np.mean((history - result['fitted'])[:, 1:] ** 2, axis=1)
+            weights = np.maximum(variance, max(variance.mean(), 1) * 1e-6)
+        reconciled = reconcile(summing, base, weights)
+
+    nodes = pd.DataFrame({
+        'Level': ['National'] + ['Town'] * len(town_labels) + ['Pharmacy'] * bottom.shape[0],
+        'Town': ['All Towns'] + list(town_labels) + [str(town) for town in bottom.index.get_level_values('TOWN')],
+        'Pharmacy': ['All Pharmacies'] * (1 + len(town_labels)) + [str(name) for name in bottom.index.get_level_values('NAME')],
+    })
+    future = _future_months(dates[order[-1]], horizon)
+    return pd.concat([nodes,
+                      pd.DataFrame(base, columns=[f'{month} base' for month in future]),
+                      pd.DataFrame(np.asarray(reconciled), columns=list(future))], axis=1)
+
+
+def simulate_paths(values, horizon, method='Damped trend', n_paths=5000, seed=0):
+    """Simulates future sales paths of every row of a series matrix by bootstrapping its one-step errors.
+
+    Each row is fitted with ``smoothing_forecast``; every path then runs the
+    same recursion forward, adding an error drawn from that row's in-sample
+    one-step errors at each month. All rows and paths are simulated together.
+    Returns an array of shape (rows, n_paths, horizon). A single month of
+    history has no one-step errors, so its paths carry no spread.
+    """
+    y = np.atleast_2d(np.asarray(values, dtype='float64'))
+    fit = smoothing_forecast(y, horizon, method)
+    residuals = (y - fit['fitted'])[:, 1:]
+    if residuals.shape[1] == 0:
+        residuals = np.zeros((y.shape[0], 1))
+    rng = np.random.default_rng(seed)
+
+    rows = np.arange(y.shape[0])[:, None]
+    alpha, beta, phi = fit['alpha'][:, None], fit['beta'][:, None], fit['phi'][:, None]
+    level = np.repeat(fit['level'][:, None], n_paths, axis=1)
+    slope = np.repeat(fit['slope'][:, None], n_paths, axis=1)
+    paths = np.empty((y.shape[0], n_paths, horizon))
+    for step in range(horizon):
+        prediction = level + phi * slope
+        simulated = prediction + residuals[rows, rng.integers(0, residuals.shape[1], (y.shape[0], n_paths))]
+        paths[:, :, step] = simulated
+        new_level = alpha * simulated + (1 - alpha) * prediction
+        slope = beta * (new_level - level) + (1 - beta) * phi * slope
+        level = new_level
+    return paths
+
+
+def inventory_plan(rollup, horizon, lead_time, service_level=0.95, method='Damped trend', n_paths=5000, seed=0):
+    """Turns simulated demand paths of every rollup row into prediction intervals and stock recommendations.
+
+    Returns one row per series with the 10th, 50th and 90th percentile of
+    demand for each future month, the mean demand over the ``lead_time``
+    months, the safety stock and the reorder point (the ``service_level``
+    quantile of lead-time demand). Simulated months with negative sales count
+    as zero demand.
+    """
+    values, last_month = _rollup_history(rollup)
+    demand = np.clip(simulate_paths(values, max(horizon, lead_time), method, n_paths, seed), 0, None)
+
+    table = _rollup_labels(rollup)
+    quantiles = np.quantile(demand[:, :, :horizon], [0.1, 0.5, 0.9], axis=1)
+    for step, month in enumerate(_future_months(last_month, horizon)):
+        for quantile, name in zip(quantiles, ['P10', 'P50', 'P90']):
+            table[f'{month} {name}'] = np.round(quantile[:, step]).astype(int)
+
+    lead_time_demand = demand[:, :, :lead_time].sum(axis=2)
+    mean_demand = lead_time_demand.mean(axis=1)
+    reorder_point = np.quantile(lead_time_demand, service_level, axis=1)
+    table['Lead-time Demand'] = np.round(mean_demand).astype(int)
+    table['Safety Stock'] = np.round(np.maximum(reorder_point - mean_demand, 0)).astype(int)
+    table['Reorder Point'] = np.round(reorder_point).astype(int)
+    return table
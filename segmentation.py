@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Clustering of customers on their recency, frequency and monetary value (RFM).
+
+Invoice lines are reduced to per-customer totals (last purchase date, number of
+invoice lines and units sold) with grouped reductions. The reduction runs chunk by
+chunk, so the size of the invoice file only bounds the reading time and not the
+memory use.
+
+A fitted segmentation can be saved together with the customer totals it was fitted
+on. Later invoice batches then only update the customers they touch, and those
+customers are reassigned with the saved model instead of reclustering everyone.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+from kneed import KneeLocator
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+# Invoice columns read by the RFM engine and the format of their dates
+INVOICE_COLUMNS = ['Name', 'Invoice Date', 'Units Sold']
+INVOICE_DATE_FORMAT = '%d/%m/%Y'
+
+# Lowest RFM score of each customer segment, best segment first; lower scores fall in DEFAULT_SEGMENT
+RFM_SEGMENTS = [(450, 'High Value Customers'), (340, 'Potential Loyalist'), (280, 'At Risk')]
+DEFAULT_SEGMENT = 'Sleelpig Customers'
+
+# Saved segmentation state, kept next to the forecast model cache
+SEGMENTATION_DIR = os.environ.get('VARICHEM_MODEL_DIR', 'models')
+SEGMENTATION_FILE = 'segmentation.pkl'
+
+# Growth of the mean distance of customers to their cluster centre, relative to the
+# fit, from which a full recluster is recommended
+DRIFT_THRESHOLD = 1.25
+
+# Most customers drawn in the interactive 3D scatter, and the grid resolution per
+# axis used to estimate density for density-aware sampling
+SCATTER_BUDGET = 5_000
+DENSITY_BINS = 16
+
+# Numbers of clusters tried by the elbow sweep
+K_RANGE = range(1, 11)
+
+# Clusters used when the sweep shows neither an elbow nor a silhouette, e.g. for a handful of customers
+DEFAULT_CLUSTERS = 3
+
+# Customer counts from which mini-batch k-means is the default
+MINIBATCH_THRESHOLD = 50_000
+
+# Customers sampled for each silhouette estimate
+SILHOUETTE_SAMPLE = 10_000
+
+
+def customer_totals(invoices):
+    """Reduces invoice lines to the Last purchase date, Frequency and MonetaryValue of each customer."""
+    return invoices.groupby('Name').agg(Last=('Invoice Date', 'max'), Frequency=('Invoice Date', 'size'),
+                                        MonetaryValue=('Units Sold', 'sum'))
+
+
+def merge_totals(totals, partial):
+    """Combines two sets of customer totals, e.g. of consecutive chunks of an invoice file."""
+    merged = pd.concat([totals, partial])
+    return merged.groupby(level=0).agg({'Last': 'max', 'Frequency': 'sum', 'MonetaryValue': 'sum'})
+
+
+def read_customer_totals(source, chunksize=1_000_000):
+    """Reads an invoice CSV chunk by chunk into customer totals.
+
+    Only the totals are kept between chunks, so memory use depends on the number
+    of customers rather than on the number of invoice lines.
+    """
+    totals = None
+    for chunk in pd.read_csv(source, usecols=lambda column: column.strip() in INVOICE_COLUMNS, chunksize=chunksize):
+        chunk.columns = chunk.columns.str.strip()
+        missing = [column for column in INVOICE_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"The invoice file has no {', '.join(missing)} column")
+        chunk['Invoice Date'] = pd.to_datetime(chunk['Invoice Date'], format=INVOICE_DATE_FORMAT)
+        partial = customer_totals(chunk)
+        totals = partial if totals is None else merge_totals(totals, partial)
+    if totals is None:
+        raise ValueError('The invoice file is empty')
+    return totals
+
+
+def rfm_table(totals, latest_date=None):
+    """Returns the Recency in days, Frequency and MonetaryValue of each customer.
+
+    Recency is counted from ``latest_date``, by default the day after the last invoice.
+    """
+    if latest_date is None:
+        latest_date = totals['Last'].max() + pd.Timedelta(days=1)
+    return pd.DataFrame({
+        'Recency': (latest_date - totals['Last']).dt.days,
+        'Frequency': totals['Frequency'],
+        'MonetaryValue': totals['MonetaryValue'],
+    })
+
+
+def rfm_scores(rfm):
+    """Returns the RFM score of each customer as the sum of its whole R, F and M values."""
+    return rfm['Recency'].astype('int') + rfm['Frequency'].astype('int') + rfm['MonetaryValue'].astype('int')
+
+
+def segment_labels(scores):
+    """Labels each RFM score with its customer segment."""
+    scores = np.asarray(scores)
+    return np.select([scores >= floor for floor, _ in RFM_SEGMENTS], [label for _, label in RFM_SEGMENTS],
+                     default=DEFAULT_SEGMENT)
+
+
+def fit_kmeans(scaled, k, minibatch=False, random_state=0):
+    """Fits k-means, or mini-batch k-means for large customer bases, to the scaled RFM values."""
+    if minibatch:
+        return MiniBatchKMeans(n_clusters=k, random_state=random_state, batch_size=4096, n_init=3).fit(scaled)
+    return KMeans(n_clusters=k, random_state=random_state).fit(scaled)
+
+
+def _sweep_fit(scaled, k, minibatch, sample_size, random_state):
+    model = fit_kmeans(scaled, k, minibatch, random_state)
+    silhouette = np.nan
+    # Identical customers can leave fewer distinct clusters than k
+    if 2 <= len(np.unique(model.labels_)) < len(scaled):
+        silhouette = silhouette_score(scaled, model.labels_, sample_size=min(sample_size, len(scaled)),
+                                      random_state=random_state)
+    return model, silhouette
+
+
+def k_sweep(scaled, k_values=K_RANGE, minibatch=False, sample_size=SILHOUETTE_SAMPLE, workers=None, random_state=0):
+    """Fits one clustering per number of clusters, each in its own worker process.
+
+    Returns a table with the Inertia and a sampled Silhouette estimate of every
+    k, and the fitted models keyed by k so the chosen one can be reused.
+    """
+    k_values = [k for k in k_values if k <= len(scaled)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        fits = list(executor.map(_sweep_fit, [scaled] * len(k_values), k_values, [minibatch] * len(k_values),
+                                 [sample_size] * len(k_values), [random_state] * len(k_values)))
+
+    sweep = pd.DataFrame({
+        'Clusters': k_values,
+        'Inertia': [model.inertia_ for model, _ in fits],
+        'Silhouette': [silhouette for _, silhouette in fits],
+    })
+    return sweep, {k: model for k, (model, _) in zip(k_values, fits)}
+
+
+def choose_clusters(sweep):
+    """Returns the elbow of the inertia curve, or the best silhouette when the curve has no elbow.
+
+    Without either, DEFAULT_CLUSTERS or the largest number of clusters swept
+    when fewer were possible.
+    """
+    elbow = None
+    if len(sweep) > 2:
+        elbow = KneeLocator(sweep['Clusters'], sweep['Inertia'], curve='convex', direction='decreasing').elbow
+    if elbow is None and sweep['Silhouette'].notna().any():
+        elbow = int(sweep.loc[sweep['Silhouette'].idxmax(), 'Clusters'])
+    if elbow is None:
+        elbow = min(DEFAULT_CLUSTERS, int(sweep['Clusters'].max()))
+    return elbow
+
+
+def scatter_sample(rfm, budget=SCATTER_BUDGET, method='stratified', seed=0):
+    """Returns at most ``budget`` customers of a clustered RFM table for plotting.
+
+    'stratified' keeps each cluster's share of the customers, with at least one
+    customer per cluster. 'density' draws customers with weights inverse to how
+    crowded their cell of an R/F/M grid is, so sparse outliers stay visible
+    while dense regions are thinned.
+    """
+    if len(rfm) <= budget:
+        return rfm
+    rng = np.random.default_rng(seed)
+    if method == 'stratified':
+        sizes = rfm['Cluster'].value_counts()
+        quotas = np.maximum(1, np.floor(sizes * budget / len(rfm))).astype('int64')
+        ranks = pd.Series(rng.random(len(rfm)), index=rfm.index).groupby(rfm['Cluster']).rank(method='first')
+        return rfm[ranks.to_numpy() <= rfm['Cluster'].map(quotas).to_numpy()]
+
+    values = rfm[['Recency', 'Frequency', 'MonetaryValue']].to_numpy(dtype='float64')
+    low, span = values.min(axis=0), np.ptp(values, axis=0)
+    bins = np.minimum((values - low) / np.where(span > 0, span, 1) * DENSITY_BINS, DENSITY_BINS - 1).astype('int64')
+    cells = np.ravel_multi_index(bins.T, (DENSITY_BINS,) * 3)
+    _, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    # Weighted sampling without replacement: keep the largest log(u) / weight keys
+    keys = np.log(rng.random(len(rfm))) * counts[inverse]
+    keep = np.sort(np.argpartition(keys, -budget)[-budget:])
+    return rfm.iloc[keep]
+
+
+def _mean_cost(scaled, labels, model):
+    return float(((scaled - model.cluster_centers_[labels]) ** 2).sum(axis=1).mean())
+
+
+def segmentation_state(totals, scaler, model, labels):
+    """Bundles the customer totals with the scaler and clustering model fitted on them.
+
+    ``labels`` are the clusters of the customers in the order of ``totals``.
+    """
+    latest_date = totals['Last'].max() + pd.Timedelta(days=1)
+    scaled = scaler.transform(rfm_table(totals, latest_date))
+    return {
+        'totals': totals,
+        'latest_date': latest_date,
+        'scaler': scaler,
+        'model': model,
+        'labels': pd.Series(labels, index=totals.index, name='Cluster'),
+        'fit_cost': _mean_cost(scaled, np.asarray(labels), model),
+        'fitted_customers': len(totals),
+        'new_customers': 0,
+        'applied_batches': [],
+    }
+
+
+def batch_digest(batch_totals):
+    """Returns a short hash of the customer totals of an invoice batch."""
+    return hashlib.sha256(pd.util.hash_pandas_object(batch_totals).to_numpy().tobytes()).hexdigest()[:16]
+
+
+def batch_applied(state, batch_totals):
+    """Tells whether an invoice batch was already folded into a segmentation state."""
+    return batch_digest(batch_totals) in state.get('applied_batches', [])
+
+
+def update_segmentation(state, batch_totals):
+    """Folds the customer totals of a new invoice batch into a saved segmentation.
+
+    Only the customers in the batch get new R/F/M totals, and only they are
+    reassigned, with the saved scaler and model's predict. Recency is counted
+    from the latest invoice of either. Returns a new state; ``state`` is unchanged.
+
+    Raises ValueError for a batch that was already applied or whose invoices
+    are all older than the state's latest date, as merging it again would
+    double-count the customers' frequency and monetary value.
+    """
+    if batch_applied(state, batch_totals):
+        raise ValueError('This invoice batch is already part of the saved segmentation')
+    if batch_totals['Last'].max() < state['latest_date']:
+        raise ValueError(f"The invoice batch has no invoices after {state['latest_date'] - pd.Timedelta(days=1):%d/%m/%Y}, "
+                         "the last day of the saved segmentation")
+
+    totals = merge_totals(state['totals'], batch_totals)
+    latest_date = max(state['latest_date'], batch_totals['Last'].max() + pd.Timedelta(days=1))
+    affected = batch_totals.index
+    scaled = state['scaler'].transform(rfm_table(totals.loc[affected], latest_date))
+
+    labels = state['labels'].reindex(totals.index)
+    labels.loc[affected] = state['model'].predict(scaled)
+    new_customers = int((~affected.isin(state['totals'].index)).sum())
+    return {**state, 'totals': totals, 'latest_date': latest_date, 'labels': labels.astype('int64'),
+            'new_customers': state['new_customers'] + new_customers,
+            'applied_batches': state.get('applied_batches', []) + [batch_digest(batch_totals)]}
+
+
+def segmented_rfm(state):
+    """Returns the RFM table of a segmentation state with each customer's Cluster."""
+    return rfm_table(state['totals'], state['latest_date']).assign(Cluster=state['labels'])
+
+
+def segmentation_drift(state):
+    """Returns the mean squared distance of customers to their cluster centre relative to the fit.
+
+    It grows as recency ages, totals change and new customers arrive; values
+    above DRIFT_THRESHOLD mean the clusters no longer describe the customer base
+    and a full recluster is warranted.
+    """
+    scaled = state['scaler'].transform(rfm_table(state['totals'], state['latest_date']))
+    cost = _mean_cost(scaled, state['labels'].to_numpy(), state['model'])
+    return cost / state['fit_cost'] if state['fit_cost'] else np.nan
+
+
+def segmentation_path(directory=SEGMENTATION_DIR):
+    return os.path.join(directory, SEGMENTATION_FILE)
+
+
+def save_segmentation(state, directory=SEGMENTATION_DIR):
+    path = segmentation_path(directory)
+    os.makedirs(directory, exist_ok=True)
+    joblib.dump(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_segmentation(directory=SEGMENTATION_DIR):
+    """Returns the saved segmentation state, or None when there is no readable one."""
+    path = segmentation_path(directory)
+    if os.path.isfile(path):
+        try:
+            return joblib.load(path)
+        except Exception:
+            pass  # An unreadable state is replaced by the next saved segmentation
+    return None